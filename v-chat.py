@@ -1,22 +1,25 @@
 import socket
+import selectors
+import struct
 import threading
-import argparse
+from collections import deque
+from itertools import islice
 import re
 import os
-import platform
 import sys
+import time
+import math
+import itertools
+import zlib
+from bisect import bisect_left
 from datetime import datetime
-try:
-    # Use colorama for cross-platform ANSI color support on Windows
-    from colorama import init
-except ImportError:
-    # Fallback if colorama is not installed
-    def init(autoreset=True):
-        pass
+# Slow-to-import modules used by only some modes (argparse, platform, secrets,
+# ssl, json, multiprocessing, colorama) are imported where they are needed,
+# so a scripted or embedded server is listening as soon as possible.
 
 # --- External Dependencies Notes ---
-# Sound playback uses 'os.system', which relies on external commands (afplay, paplay, winsound).
-# This is kept as a demonstration but clarified it needs system-specific tools/files.
+# Sound playback uses winsound on Windows and an external player elsewhere
+# (afplay, paplay or aplay), falling back to the terminal bell.
 
 # --- ANSI Color Setup ---
 # Defined colors for the CLI aesthetic
@@ -30,8 +33,12 @@ COLORS = {
 
 def clear_screen():
     """Clears the terminal screen cross-platform."""
-    # os.system is used to run shell commands to clear the screen.
-    os.system('cls' if platform.system() == "Windows" else 'clear')
+    if os.name == 'nt':
+        os.system('cls')
+    else:
+        # What 'clear' prints, without starting a shell and a process
+        sys.stdout.write('\033[H\033[2J\033[3J')
+        sys.stdout.flush()
 
 def print_banner():
     """Prints the application banner with colors using a simple line-based ASCII design, including author info."""
@@ -94,35 +101,1744 @@ def choose_color(prompt):
         except ValueError:
             print(f"{COLORS['red']}Please enter a number.{COLORS['reset']}")
 
-class SoundNotifier:
-    """Class to handle cross-platform sound playback (best effort)."""
-    # NOTE: Since we cannot guarantee the existence of specific sound files, 
-    # this function provides system-level sound as a best-effort fallback.
-    @staticmethod
-    def play_sound(sound_type="notify"):
-        """Plays a system-level notification sound."""
-        system = platform.system()
-        
+# Notification sounds: a burst of messages plays one sound, and a mention
+# outranks a generic notify that is still waiting to play
+SOUND_WINDOW = 1.0  # Default minimum seconds between two sounds
+SOUND_PRIORITY = {'notify': 1, 'mention': 2}
+SOUND_PLAYERS = (
+    ('afplay', {'notify': '/System/Library/Sounds/Ping.aiff', 'mention': '/System/Library/Sounds/Glass.aiff'}),
+    ('paplay', {'notify': '/usr/share/sounds/freedesktop/stereo/message-new-instant.oga',
+                'mention': '/usr/share/sounds/freedesktop/stereo/bell.oga'}),
+    ('aplay', {'notify': '/usr/share/sounds/alsa/Front_Center.wav'}),
+)
+
+class SoundNotifier(threading.Thread):
+    """Plays notification sounds (best effort) on a background thread, at most one per `window` seconds.
+
+    notify() only records the request, so the receive loop never waits on audio.
+    Windows beeps in-process; elsewhere the first player found on PATH is started
+    directly (no shell), never more than one at a time, and the terminal bell is
+    the fallback.
+    """
+    def __init__(self, window=SOUND_WINDOW):
+        super().__init__(daemon=True)
+        self.window = window
+        self.enabled = True
+        self.pending = None  # Highest-priority sound requested since the last one played
+        self.cond = threading.Condition()
+        self.commands = None  # {kind: argv}, looked up on the first sound
+        self.player = None    # The player process currently running, if any
+        self.player_sound = None
+        self.start()
+
+    def notify(self, sound_type="notify"):
+        """Asks for a sound; never blocks."""
+        if not self.enabled:
+            return
+        with self.cond:
+            if SOUND_PRIORITY.get(sound_type, 0) > SOUND_PRIORITY.get(self.pending, 0):
+                self.pending = sound_type
+            self.cond.notify()
+
+    def run(self):
+        """Plays pending sounds, leaving at least `window` seconds between them."""
+        last_played = -math.inf
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+            # Whatever else arrives before the window is over joins this sound
+            delay = last_played + self.window - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.cond:
+                sound_type, self.pending = self.pending, None
+            if self.enabled:
+                self.play(sound_type)
+                last_played = time.monotonic()
+
+    def play(self, sound_type):
+        """Plays one sound; failures are silent."""
         try:
-            if system == "Darwin":
-                # macOS
-                os.system('afplay /System/Library/Sounds/Ping.aiff &')
-            elif system == "Linux":
-                # Linux (requires paplay or similar)
-                os.system('paplay /usr/share/sounds/freedesktop/stereo/message-new-instant.oga &')
-            elif system == "Windows":
-                # Windows (requires winsound module)
+            if os.name == 'nt':
                 import winsound
-                winsound.MessageBeep(winsound.MB_ICONASTERISK)
-            return
+                winsound.MessageBeep(winsound.MB_ICONEXCLAMATION if sound_type == 'mention' else winsound.MB_ICONASTERISK)
+                return
+            if self.commands is None:
+                self.commands = self.find_player()
+            command = self.commands.get(sound_type) or self.commands.get('notify')
+            if command is None:
+                sys.stdout.write('\a')  # Terminal bell
+                sys.stdout.flush()
+            else:
+                import subprocess
+                if self.player is not None and self.player.poll() is None:
+                    # Still playing: that sound covers this request too, unless this one outranks it
+                    if SOUND_PRIORITY.get(sound_type, 0) <= SOUND_PRIORITY.get(self.player_sound, 0):
+                        return
+                    self.player.terminate()
+                    self.player.wait()
+                self.player = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                self.player_sound = sound_type
         except Exception:
             # Silent failure if sound cannot be played
             pass
 
-class ChatServer:
-    def __init__(self, host, port, username, user_color, arrow_color):
-        self.clients = {}  # {socket: (username, user_color, arrow_color)}
+    @staticmethod
+    def find_player():
+        """Returns {sound_type: argv} for the first installed player with its sound files, or {}."""
+        import shutil
+        for player, files in SOUND_PLAYERS:
+            path = shutil.which(player)
+            if path is None:
+                continue
+            commands = {kind: [path, file] for kind, file in files.items() if os.path.exists(file)}
+            if 'notify' in commands:
+                return commands
+        return {}
+
+# --- Wire Protocol ---
+# Every frame on the wire is: 4-byte big-endian payload length | 1-byte type | payload.
+# Frames are self-delimiting, so TCP may split or coalesce them freely.
+FRAME_HEADER = struct.Struct('!IB')
+FRAME_HANDSHAKE = 1  # "username|user_color|arrow_color[|capability,...]" (first frame from a client)
+FRAME_TEXT = 2       # Chat text or command line (UTF-8)
+FRAME_SOUND = 3      # Sound trigger name, e.g. "notify" or "mention"
+FRAME_CHAT = 4       # Sequenced room broadcast: 8-byte sequence number | UTF-8 text
+FRAME_FIELDS = 5     # Unrendered FRAME_CHAT: seq | "time\0username\0user_color\0arrow_color\0message"
+FRAME_PING = 6       # Heartbeat request (either direction); the payload is echoed back
+FRAME_PONG = 7       # Heartbeat reply
+FRAME_SESSION = 8    # Resume token issued to clients that asked for the 'resume' capability
+FRAME_COMPRESS = 9   # "deflate": everything the server sends after this frame is one deflate stream
+FRAME_RETRY = 10     # Resume refused because another worker holds the session; reconnect and try again
+FRAME_SEQ = 11       # 8-byte sequence number of a broadcast the client was left out of (its own line or notice)
+FRAME_TOO_LARGE = 0  # Reported by FrameDecoder for a skipped oversized frame; payload is its length
+MAX_FRAME_SIZE = 64 * 1024  # Default largest accepted payload, in bytes
+TRUSTED_MAX_FRAME_SIZE = 16 * 1024 * 1024  # Relay links and server-to-client frames wrap user messages
+
+def encode_frame(frame_type, payload):
+    """Encodes a single frame; str payloads are UTF-8 encoded."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+CHAT_SEQ = struct.Struct('!Q')
+SEQ_PATTERN = re.compile(r'^[0-9]{1,20}$')  # A sequence number as typed; longer strings are refused before int()
+
+def encode_chat_frame(seq, text_bytes, frame_type=FRAME_CHAT):
+    """Encodes a FRAME_CHAT (or FRAME_FIELDS) frame from a sequence number and pre-encoded text."""
+    return FRAME_HEADER.pack(CHAT_SEQ.size + len(text_bytes), frame_type) + CHAT_SEQ.pack(seq) + text_bytes
+
+# Sound triggers never change, so they are encoded once
+SOUND_NOTIFY_FRAME = encode_frame(FRAME_SOUND, "notify")
+SOUND_MENTION_FRAME = encode_frame(FRAME_SOUND, "mention")
+PING_FRAME = encode_frame(FRAME_PING, b"")
+RETRY_FRAME = encode_frame(FRAME_RETRY, b"")
+
+class FrameDecoder:
+    """Incremental decoder that turns an arbitrary byte stream into complete frames.
+
+    Frames larger than `max_frame_size` are never buffered: their payload is
+    discarded as it streams in and a (FRAME_TOO_LARGE, length) pair is reported.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        self.skip = 0  # Bytes of an oversized payload still to discard
+
+    def feed(self, data):
+        """Adds received bytes and returns every completed (frame_type, payload) pair."""
+        buf = self.buffer
+        buf += data
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        end = len(buf)
+        while True:
+            if self.skip:
+                skipped = min(self.skip, end - offset)
+                offset += skipped
+                self.skip -= skipped
+                if self.skip:
+                    break
+            if end - offset < header_size:
+                break
+            length, frame_type = FRAME_HEADER.unpack_from(buf, offset)
+            if length > self.max_frame_size:
+                frames.append((FRAME_TOO_LARGE, str(length).encode('ascii')))
+                offset += header_size
+                self.skip = length
+                continue
+            start = offset + header_size
+            if end - start < length:
+                break # Wait for the rest of the payload
+            frames.append((frame_type, bytes(buf[start:start + length])))
+            offset = start + length
+        if offset:
+            del buf[:offset]
+        return frames
+
+# --- Compression ---
+# Clients that list 'deflate' in the handshake get a per-connection raw deflate
+# stream (server to client only). Each write is a Z_SYNC_FLUSH block, so the
+# stream stays decodable as it arrives while the shared window keeps repeated
+# names, timestamps and colour codes cheap. The preset dictionary primes that
+# window with what chat lines are made of; both ends build it the same way.
+COMPRESSION_WBITS = 13    # 8 KB window: ~100 KB of zlib state per compressed connection
+COMPRESSION_MEMLEVEL = 7
+COMPRESSION_DICTIONARY = ''.join(
+    ['[*] ', '[!] ', '[+] ', ' has joined the chat!', ' has left gracefully.', ' has disconnected unexpectedly.',
+     'Online users: ', '[PM @', '--- Recent messages in #lobby ---', '--- You are up to date ---']
+    + [f"{code}[00:00:00 " for code in COLORS.values()]
+    + [f"]{COLORS['reset']} {code}»{COLORS['reset']} " for code in COLORS.values()]
+).encode('utf-8') + b'\0' * 7  # Most frames start with a small length and a 64-bit sequence number
+COMPRESS_ACK_FRAME = encode_frame(FRAME_COMPRESS, "deflate")
+
+def new_deflater(level):
+    """Returns the server-side compressor for one connection."""
+    return zlib.compressobj(level, zlib.DEFLATED, -COMPRESSION_WBITS, COMPRESSION_MEMLEVEL,
+                            zdict=COMPRESSION_DICTIONARY)
+
+class StreamInflater:
+    """Client side of a negotiated compressed stream.
+
+    Passes bytes through until the server's first frame shows whether it
+    accepted compression; after a FRAME_COMPRESS ack, inflates everything.
+    """
+    def __init__(self):
+        self.pending = b''
+        self.inflater = None
+        self.settled = False
+
+    def feed(self, data):
+        """Returns the plain bytes carried by `data` (possibly none yet)."""
+        if self.inflater is not None:
+            return self.inflater.decompress(data)
+        if self.settled:
+            return data
+        data = self.pending + data
+        self.pending = b''
+        if len(data) >= FRAME_HEADER.size:
+            length, frame_type = FRAME_HEADER.unpack_from(data)
+            if frame_type != FRAME_COMPRESS:
+                self.settled = True # The server does not compress
+                return data
+            end = FRAME_HEADER.size + length
+            if len(data) >= end:
+                self.inflater = zlib.decompressobj(-COMPRESSION_WBITS, zdict=COMPRESSION_DICTIONARY)
+                return self.inflater.decompress(data[end:])
+        self.pending = data
+        return b''
+
+# --- TLS ---
+# Optional TLS (--tls-cert/--tls-key on the server, --tls on the client). ssl is
+# imported only when TLS is used. Connections are wrapped in TlsChannel, which
+# drives an SSLObject through memory BIOs instead of using ssl.SSLSocket:
+# one thread can read while another writes, and a non-blocking handshake just
+# advances inside recv() so neither engine's accept loop ever waits on it.
+TLS_READ_SIZE = 65536
+
+def server_tls_context(certfile, keyfile=None):
+    """Builds the server's TLS context; session tickets make reconnects a single round trip."""
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+def client_tls_context(cafile=None, verify=True):
+    """Builds a client TLS context; `cafile` trusts a self-signed server certificate."""
+    import ssl
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+class TlsChannel:
+    """A socket-like TLS connection over a plain socket.
+
+    recv() and send() may run on different threads: the SSL object is only
+    touched under `ssl_lock`, and encrypted bytes reach the socket in order
+    under `wire_lock`. On a non-blocking socket, recv() raises BlockingIOError
+    when it produced no application data (e.g. mid-handshake), and encrypted
+    bytes the kernel did not take wait in `backlog` for flush(). Other socket
+    methods are passed straight through.
+    """
+    def __init__(self, sock, sslobj, incoming, outgoing):
+        self.sock = sock
+        self.sslobj = sslobj
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.ssl_lock = threading.Lock()
+        self.wire_lock = threading.Lock()
+        self.backlog = b''
+        self.handshaken = False
+
+    @classmethod
+    def server(cls, context, sock):
+        """Wraps an accepted socket; the handshake happens in the first recv() calls."""
+        import ssl
+        incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+        return cls(sock, context.wrap_bio(incoming, outgoing, server_side=True), incoming, outgoing)
+
+    @classmethod
+    def client(cls, context, sock, hostname, session=None):
+        """Wraps a connected socket, offering `session` for resumption."""
+        import ssl
+        incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+        sslobj = context.wrap_bio(incoming, outgoing, server_hostname=hostname, session=session)
+        return cls(sock, sslobj, incoming, outgoing)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    @property
+    def session(self):
+        return self.sslobj.session
+
+    @property
+    def session_reused(self):
+        return self.sslobj.session_reused
+
+    def do_handshake(self):
+        """Completes the handshake on a blocking socket."""
+        import ssl
+        while True:
+            with self.ssl_lock:
+                try:
+                    self.sslobj.do_handshake()
+                    self.handshaken = True
+                except ssl.SSLWantReadError:
+                    pass
+            self.flush()
+            if self.handshaken:
+                return
+            data = self.sock.recv(TLS_READ_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed during the TLS handshake")
+            with self.ssl_lock:
+                self.incoming.write(data)
+
+    def recv(self, bufsize):
+        """Returns decrypted bytes (possibly more than bufsize), or b'' once the peer has closed."""
+        import ssl
+        while True:
+            data = self.sock.recv(TLS_READ_SIZE)
+            if not data:
+                return b''
+            chunks = []
+            closed = False
+            with self.ssl_lock:
+                self.incoming.write(data)
+                try:
+                    if not self.handshaken:
+                        self.sslobj.do_handshake()
+                        self.handshaken = True
+                    while True:
+                        chunk = self.sslobj.read(bufsize)
+                        if not chunk:
+                            closed = True
+                            break
+                        chunks.append(chunk)
+                except ssl.SSLWantReadError:
+                    pass
+                except ssl.SSLZeroReturnError:
+                    closed = True
+            # Handshake replies and session tickets
+            self.flush()
+            if chunks:
+                return b''.join(chunks)
+            if closed:
+                return b''
+            if self.sock.gettimeout() == 0.0:
+                raise BlockingIOError("No application data yet")
+
+    def send(self, data):
+        """Encrypts `data` in one SSL write and sends it. Returns len(data)."""
+        with self.wire_lock:
+            if self.backlog:
+                self.backlog = self._write_raw(self.backlog)
+                if self.backlog:
+                    raise BlockingIOError("TLS backlog not yet written")
+            with self.ssl_lock:
+                if not self.handshaken:
+                    raise BlockingIOError("TLS handshake not complete")
+                self.sslobj.write(data)
+                encrypted = self.outgoing.read()
+            self.backlog = self._write_raw(encrypted)
+        return len(data)
+
+    sendall = send
+
+    def flush(self):
+        """Writes encrypted bytes that are waiting, as far as the socket takes them."""
+        if not self.backlog and not self.outgoing.pending:
+            return
+        with self.wire_lock:
+            with self.ssl_lock:
+                data = self.backlog + self.outgoing.read()
+            self.backlog = self._write_raw(data)
+
+    def _write_raw(self, data):
+        """Sends encrypted bytes; returns what a non-blocking socket did not take."""
+        if not data:
+            return b''
+        if self.sock.gettimeout() != 0.0:
+            self.sock.sendall(data)
+            return b''
+        try:
+            sent = self.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        return data[sent:]
+
+# --- Outbound Queues ---
+# Broadcast frames are encoded once and the same bytes object is queued to every
+# recipient; each client drains its own bounded queue, batching frames per syscall.
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect', 'coalesce')
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+def write_buffers(sock, buffers):
+    """Writes a list of buffers with one writev-style syscall. Returns bytes sent."""
+    # A TlsChannel gets the batch as one buffer: a single SSL write, not one per frame
+    if HAVE_SENDMSG and type(sock) is socket.socket:
+        return sock.sendmsg(buffers)
+    return sock.send(b''.join(buffers))
+
+class OutboundQueue:
+    """Bounded per-client queue of encoded frames with a slow-consumer policy.
+
+    When the queue is full a new frame is either dropped ('drop'), the client is
+    flagged for disconnection ('disconnect'), or the backlog is collapsed into a
+    single "messages skipped" notice ('coalesce'). Not thread-safe on its own.
+    """
+    def __init__(self, max_frames=1024, max_bytes=1024 * 1024, policy='coalesce'):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.frames = deque()     # Encoded frames (shared bytes or a memoryview tail)
+        self.droppable = deque()  # Parallel flags: True for frames safe to discard (sound triggers)
+        self.queued_bytes = 0
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.head_partial = False # The head frame was partially written and must be kept
+        self.dropped = 0
+        self.compressor = None    # Deflate stream for this client, once negotiated
+        self.sealed = 0           # Head entries already in wire form: never coalesced or recompressed
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, data, droppable=False):
+        """Queues an encoded frame. Returns False if the client should be disconnected."""
+        if len(self.frames) >= self.max_frames or self.queued_bytes + len(data) > self.max_bytes:
+            if droppable or self.policy == 'drop':
+                self.dropped += 1
+                return True
+            if self.policy == 'disconnect':
+                return False
+            self._coalesce()
+        self.frames.append(data)
+        self.droppable.append(droppable)
+        self.queued_bytes += len(data)
+        return True
+
+    def start_compression(self, level):
+        """Queues the uncompressed ack; every frame queued after it is deflated on the way out."""
+        self.frames.append(COMPRESS_ACK_FRAME)
+        self.droppable.append(False)
+        self.queued_bytes += len(COMPRESS_ACK_FRAME)
+        self.sealed = len(self.frames)
+        self.compressor = new_deflater(level)
+
+    def seal(self):
+        """With compression on, deflates every frame queued after the sealed head into one block."""
+        count = len(self.frames) - self.sealed
+        if self.compressor is None or count <= 0:
+            return
+        raw = [self.frames.pop() for _ in range(count)]
+        raw.reverse()
+        for _ in range(count):
+            self.droppable.pop()
+        data = b''.join(raw)
+        block = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.frames.append(block)
+        self.droppable.append(False)
+        self.queued_bytes += len(block) - len(data)
+        self.sealed += 1
+
+    def _coalesce(self):
+        """Replaces the queued backlog with a single notice frame."""
+        keep = max(1 if self.head_partial else 0, self.sealed)
+        skipped = sum(1 for flag in islice(self.droppable, keep, None) if not flag)
+        while len(self.frames) > keep:
+            self.queued_bytes -= len(self.frames.pop())
+            self.droppable.pop()
+        self.dropped += skipped
+        notice = encode_frame(FRAME_TEXT, f"{COLORS['red']}[!] Skipped {skipped} messages: your connection is too slow.{COLORS['reset']}")
+        self.frames.append(notice)
+        self.droppable.append(False)
+        self.queued_bytes += len(notice)
+
+    def clear(self):
+        """Discards everything still queued."""
+        self.frames.clear()
+        self.droppable.clear()
+        self.queued_bytes = 0
+        self.head_partial = False
+        self.sealed = 0
+
+    def take(self, limit=IOV_MAX):
+        """Removes and returns up to `limit` frames for a blocking writer."""
+        self.seal()
+        batch = []
+        while self.frames and len(batch) < limit:
+            frame = self.frames.popleft()
+            self.droppable.popleft()
+            self.queued_bytes -= len(frame)
+            batch.append(frame)
+        self.head_partial = False
+        self.sealed = max(0, self.sealed - len(batch))
+        return batch
+
+    def write_to(self, sock):
+        """Writes queued frames to a non-blocking socket until empty or it would block."""
+        self.seal()
+        frames = self.frames
+        while frames:
+            sent = write_buffers(sock, list(islice(frames, IOV_MAX)))
+            self.queued_bytes -= sent
+            # Pop fully written frames and keep the unwritten tail of a partial one
+            while sent:
+                size = len(frames[0])
+                if sent < size:
+                    frames[0] = memoryview(frames[0])[sent:]
+                    self.head_partial = True
+                    break
+                frames.popleft()
+                self.droppable.popleft()
+                sent -= size
+                self.head_partial = False
+                if self.sealed:
+                    self.sealed -= 1
+            else:
+                continue
+            break # Partial write: the kernel buffer is full
+
+# --- Client Registry ---
+class ClientRegistry:
+    """Thread-safe registry of connected clients with O(1) lookup by socket and by username.
+
+    Username claims are serialized on one of several lock stripes (picked by the
+    name's hash), so two connections can never claim the same name while claims
+    for different names do not contend. Membership changes invalidate a cached
+    snapshot tuple that fan-out iterates without copying the tables per message.
+    """
+    def __init__(self, stripes=16):
+        self.clients = {}    # {socket: (username, user_color, arrow_color)}
         self.usernames = {}  # {username: socket}
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._members_lock = threading.Lock()
+        self._snapshot = ()
+        self._sockets = ()
+        self._snapshot_valid = True
+
+    def _stripe(self, username):
+        """Returns the lock guarding claims for this username."""
+        return self._stripes[hash(username) % len(self._stripes)]
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, client_socket):
+        return client_socket in self.clients
+
+    def get(self, client_socket):
+        """Returns (username, user_color, arrow_color) for a socket, or None."""
+        return self.clients.get(client_socket)
+
+    def socket_for(self, username):
+        """Returns the socket registered under a username, or None."""
+        return self.usernames.get(username)
+
+    def register(self, client_socket, username, user_color, arrow_color):
+        """Atomically claims the username and registers the socket. Returns False if the name is taken."""
+        with self._stripe(username):
+            if username in self.usernames:
+                return False
+            self.usernames[username] = client_socket
+        with self._members_lock:
+            self.clients[client_socket] = (username, user_color, arrow_color)
+            self._snapshot_valid = False
+        return True
+
+    def unregister(self, client_socket):
+        """Removes a socket and releases its username. Returns its entry, or None if already removed."""
+        with self._members_lock:
+            entry = self.clients.pop(client_socket, None)
+            if entry is None:
+                return None
+            self._snapshot_valid = False
+        username = entry[0]
+        with self._stripe(username):
+            if self.usernames.get(username) is client_socket:
+                del self.usernames[username]
+        return entry
+
+    def rebind(self, old_socket, new_socket):
+        """Moves a registered user to a new socket, keeping the username claimed. Returns the entry or None."""
+        with self._members_lock:
+            entry = self.clients.pop(old_socket, None)
+            if entry is None:
+                return None
+            self.clients[new_socket] = entry
+            self._snapshot_valid = False
+        with self._stripe(entry[0]):
+            if self.usernames.get(entry[0]) is old_socket:
+                self.usernames[entry[0]] = new_socket
+        return entry
+
+    def snapshot(self):
+        """Returns an immutable tuple of (socket, entry) pairs, rebuilt only after membership changes."""
+        if not self._snapshot_valid:
+            with self._members_lock:
+                if not self._snapshot_valid:
+                    self._snapshot = tuple(self.clients.items())
+                    self._sockets = tuple(self.clients)
+                    self._snapshot_valid = True
+        return self._snapshot
+
+    def sockets(self):
+        """Returns the cached tuple of registered sockets for fan-out."""
+        if not self._snapshot_valid:
+            self.snapshot()
+        return self._sockets
+
+# --- Flood Control ---
+THROTTLE_NOTICE_INTERVAL = 1.0  # Seconds between "slow down" notices to one client
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens/sec up to `burst`; O(1) per check."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def available(self, now):
+        """Refills for the time elapsed since the last check and returns the tokens held."""
+        elapsed = now - self.stamp
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.stamp = now
+        return self.tokens
+
+def take_tokens(buckets, now):
+    """Takes (bucket, amount) pairs all-or-nothing. Returns False if any bucket is short."""
+    for bucket, amount in buckets:
+        # A single message larger than the burst is let through on a full bucket
+        # and leaves it in debt, so it still costs its full size
+        if bucket.available(now) < min(amount, bucket.burst):
+            return False
+    for bucket, amount in buckets:
+        bucket.tokens -= amount
+    return True
+
+class FloodLimiter:
+    """Message and byte token buckets for one sender (a client or a room)."""
+    __slots__ = ('buckets', 'notified_at', 'throttled', 'lock')
+
+    def __init__(self, msg_rate=0, byte_rate=0, burst_factor=2.0):
+        self.buckets = []
+        if msg_rate:
+            self.buckets.append((TokenBucket(msg_rate, msg_rate * burst_factor), 1))
+        if byte_rate:
+            self.buckets.append((TokenBucket(byte_rate, byte_rate * burst_factor), None))
+        self.notified_at = 0.0
+        self.throttled = 0
+        self.lock = threading.Lock()  # Room limiters are shared by every member's reader
+
+    def __bool__(self):
+        return bool(self.buckets)
+
+    def admit(self, size, now):
+        """Accounts one message of `size` bytes. Returns False if it must be dropped."""
+        with self.lock:
+            if take_tokens([(bucket, size if amount is None else amount) for bucket, amount in self.buckets], now):
+                return True
+            self.throttled += 1
+            return False
+
+    def should_notify(self, now):
+        """Returns True at most once per THROTTLE_NOTICE_INTERVAL."""
+        if now - self.notified_at < THROTTLE_NOTICE_INTERVAL:
+            return False
+        self.notified_at = now
+        return True
+
+# --- Heartbeats ---
+HEARTBEAT_TICK = 1.0  # Seconds per timer-wheel slot
+CLIENT_PING_AFTER = 15.0    # The client pings a server it has not heard from for this long...
+CLIENT_DEAD_AFTER = 45.0    # ...and reconnects once the silence lasts this long
+RECONNECT_MIN_DELAY = 0.5   # Client reconnect backoff: doubles per failed attempt, with jitter
+RECONNECT_MAX_DELAY = 30.0
+PENDING_LIMIT = 100         # Messages typed while reconnecting that are kept for sending
+
+def set_keepalive(sock, idle, interval=None, count=3):
+    """Enables TCP keepalive probes after `idle` seconds of silence, where supported."""
+    interval = interval or max(1, idle // 3)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif hasattr(socket, 'TCP_KEEPALIVE'):
+            # macOS spelling of TCP_KEEPIDLE
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError:
+        pass # Best effort: the application-level heartbeat still applies
+
+def set_nodelay(sock):
+    """Disables Nagle's algorithm: frames are already batched per write, and Nagle
+    plus delayed ACKs would hold back the second of two quick writes by ~40 ms."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+class TimerWheel:
+    """Hashed timer wheel: O(1) scheduling, and expiry work proportional to the timers due.
+
+    Deadlines are rounded up to whole ticks; ones further away than a full turn
+    stay in their slot until the wheel comes round to them.
+    """
+    def __init__(self, tick=HEARTBEAT_TICK, slots=512, now=None):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.cursor = int((time.monotonic() if now is None else now) / tick)  # Last tick processed
+
+    def schedule(self, key, deadline):
+        """Fires `key` from advance() once `deadline` (monotonic seconds) has passed."""
+        due = max(math.ceil(deadline / self.tick), self.cursor + 1)
+        self.slots[due % len(self.slots)].append((due, key))
+
+    def advance(self, now):
+        """Returns the keys of every timer that came due up to `now`."""
+        expired = []
+        target = int(now / self.tick)
+        while self.cursor < target:
+            self.cursor += 1
+            index = self.cursor % len(self.slots)
+            bucket = self.slots[index]
+            if not bucket:
+                continue
+            self.slots[index] = later = []
+            for due, key in bucket:
+                if due <= self.cursor:
+                    expired.append(key)
+                else:
+                    later.append((due, key))
+        return expired
+
+class Heartbeat:
+    """Tracks when each connection was last heard from and decides when to ping or drop it.
+
+    Activity only updates a timestamp; each connection has a single wheel timer
+    that, when it fires, either acts or re-arms itself for the real deadline.
+    """
+    def __init__(self, interval=30.0, idle_timeout=90.0, handshake_timeout=10.0):
+        self.interval = interval                    # Ping after this much silence (0: never)
+        self.idle_timeout = idle_timeout            # Drop after this much silence (0: never)
+        self.handshake_timeout = handshake_timeout  # Drop if not registered by then (0: never)
+        self.peers = {}  # {socket: [last_seen, connected_at, pinged_at]}
+        self.wheel = TimerWheel()
+        self.lock = threading.Lock()
+
+    def track(self, client_socket):
+        """Starts watching a new connection."""
+        now = time.monotonic()
+        with self.lock:
+            self.peers[client_socket] = [now, now, 0.0]
+            self.wheel.schedule(client_socket, now + (self.handshake_timeout or self.interval or self.idle_timeout))
+
+    def touch(self, client_socket):
+        """Records inbound traffic from a connection."""
+        peer = self.peers.get(client_socket)
+        if peer is not None:
+            peer[0] = time.monotonic()
+
+    def forget(self, client_socket):
+        """Stops watching a closed connection (its timer is discarded when it fires)."""
+        with self.lock:
+            self.peers.pop(client_socket, None)
+
+    def expire(self, now, is_registered):
+        """Returns [(socket, action)] with action 'ping' or a reason to drop it."""
+        actions = []
+        with self.lock:
+            for client_socket in self.wheel.advance(now):
+                peer = self.peers.get(client_socket)
+                if peer is None:
+                    continue
+                last_seen, connected_at, pinged_at = peer
+                if not is_registered(client_socket):
+                    if self.handshake_timeout and now - connected_at >= self.handshake_timeout:
+                        self.peers.pop(client_socket, None)
+                        actions.append((client_socket, f"no handshake within {self.handshake_timeout:g}s"))
+                        continue
+                    deadline = connected_at + self.handshake_timeout if self.handshake_timeout else now + self.wheel.tick
+                else:
+                    if self.idle_timeout and now - last_seen >= self.idle_timeout:
+                        self.peers.pop(client_socket, None)
+                        actions.append((client_socket, f"silent for {self.idle_timeout:g}s"))
+                        continue
+                    # Ping after `interval` of silence, and again every interval while it lasts
+                    quiet_since = max(last_seen, pinged_at)
+                    if self.interval and now - quiet_since >= self.interval:
+                        peer[2] = quiet_since = now
+                        actions.append((client_socket, 'ping'))
+                    deadlines = []
+                    if self.interval:
+                        deadlines.append(quiet_since + self.interval)
+                    if self.idle_timeout:
+                        deadlines.append(last_seen + self.idle_timeout)
+                    if not deadlines:
+                        continue # Only the handshake was being timed
+                    deadline = min(deadlines)
+                self.wheel.schedule(client_socket, deadline)
+        return actions
+
+# --- Metrics ---
+# Metric families: {name: (type, help)}. Counters may carry one label, e.g. commands by name.
+METRIC_FAMILIES = {
+    'vchat_connections_total': ('counter', 'TCP connections accepted.'),
+    'vchat_disconnects_total': ('counter', 'Registered clients that left, by reason.'),
+    'vchat_frames_in_total': ('counter', 'Frames received from clients, by type.'),
+    'vchat_bytes_in_total': ('counter', 'Payload bytes received from clients.'),
+    'vchat_frames_out_total': ('counter', 'Frames queued for clients.'),
+    'vchat_bytes_out_total': ('counter', 'Bytes queued for clients.'),
+    'vchat_commands_total': ('counter', 'Slash commands handled, by command.'),
+    'vchat_broadcasts_total': ('counter', 'Messages fanned out to a room or to everyone.'),
+    'vchat_private_messages_total': ('counter', 'Private messages sent.'),
+    'vchat_send_errors_total': ('counter', 'Socket errors while sending to clients.'),
+    'vchat_slow_consumer_disconnects_total': ('counter', 'Clients disconnected for not keeping up.'),
+    'vchat_throttled_total': ('counter', 'Messages dropped by the flood limits, by scope.'),
+    'vchat_oversized_total': ('counter', 'Frames rejected for exceeding the message size limit.'),
+    'vchat_pings_total': ('counter', 'Heartbeat pings sent to silent clients.'),
+    'vchat_timeouts_total': ('counter', 'Connections dropped by the handshake or idle timeout.'),
+    'vchat_sessions_parked_total': ('counter', 'Dropped connections whose session was held for resumption.'),
+    'vchat_sessions_resumed_total': ('counter', 'Sessions reattached with a resume token.'),
+    'vchat_compressed_connections_total': ('counter', 'Connections that negotiated deflate compression.'),
+    'vchat_tls_clients_total': ('counter', 'TLS clients that completed a handshake, by whether it resumed a session.'),
+    'vchat_broadcast_fanout_seconds': ('histogram', 'Time to queue one broadcast for every recipient.'),
+    'vchat_clients': ('gauge', 'Registered clients on this server.'),
+    'vchat_rooms': ('gauge', 'Rooms that currently exist.'),
+    'vchat_send_queue_frames': ('gauge', 'Frames waiting in client send queues (sum and max).'),
+    'vchat_send_queue_bytes': ('gauge', 'Bytes waiting in client send queues (sum and max).'),
+    'vchat_send_queue_dropped': ('gauge', 'Frames dropped or coalesced by live client send queues.'),
+    'vchat_uptime_seconds': ('gauge', 'Seconds since the server started.'),
+}
+FRAME_LABELS = {FRAME_HANDSHAKE: 'type="handshake"', FRAME_TEXT: 'type="text"', FRAME_TOO_LARGE: 'type="oversized"',
+                FRAME_PING: 'type="ping"', FRAME_PONG: 'type="pong"'}
+FANOUT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+STATS_COMMANDS = frozenset(('msg', 'users', 'help', 'join', 'part', 'rooms', 'history', 'since', 'stats', 'exit'))
+
+class Histogram:
+    """Fixed-bucket histogram; `counts[i]` holds observations <= bounds[i] (last slot: +Inf)."""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding quantile q (None if empty or beyond the last bound)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+class Metrics:
+    """Thread-safe counters and histograms, rendered as Prometheus text or a /stats summary.
+
+    Servers keep `metrics = None` when disabled, so each hot-path hook costs a
+    single `is not None` test. Gauges are not tracked at all: `gauges()` is a
+    callback that computes them from live server state when scraped.
+    """
+    def __init__(self, gauges=None):
+        self.counters = {}  # {(name, label): value}
+        self.histograms = {'vchat_broadcast_fanout_seconds': Histogram(FANOUT_BUCKETS)}
+        self.gauges = gauges or (lambda: [])
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, label=''):
+        """Adds `amount` to a counter; `label` is a pre-rendered label set like 'command="msg"'."""
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value):
+        """Records one histogram observation."""
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def counter(self, name, label=None):
+        """Returns a counter's value, summed over labels unless one is given."""
+        with self.lock:
+            return sum(value for (key, key_label), value in self.counters.items()
+                       if key == name and (label is None or key_label == label))
+
+    def render_prometheus(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [(name, list(h.counts), h.sum, h.count) for name, h in self.histograms.items()]
+        samples = {}  # {family: [(label, value)]}
+        for (name, label), value in counters:
+            samples.setdefault(name, []).append((label, value))
+        for name, label, value in self.gauges():
+            samples.setdefault(name, []).append((label, value))
+        samples.setdefault('vchat_uptime_seconds', []).append(('', round(time.time() - self.started, 3)))
+
+        lines = []
+        for name, (kind, help_text) in METRIC_FAMILIES.items():
+            if kind == 'histogram':
+                continue
+            if name not in samples and kind == 'counter':
+                samples[name] = [('', 0)]
+            if name not in samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for label, value in samples[name]:
+                lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+        for name, counts, total, count in histograms:
+            kind, help_text = METRIC_FAMILIES[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            cumulative = 0
+            for bound, bucket in zip(FANOUT_BUCKETS + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum {total:.6f}")
+            lines.append(f"{name}_count {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        """Serves /metrics over HTTP from a daemon thread. Returns the HTTP server."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Scrapes would otherwise flood the chat console
+
+        httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+# --- Console & Logging ---
+ANSI_PATTERN = re.compile(r'\x1b\[[0-9;]*m')
+CONSOLE_BUFFER = 10000          # Records held for the writer before new ones are dropped
+LOG_FILE_MAX_BYTES = 16 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+
+class RotatingJsonLog:
+    """Append-only JSON-lines file rotated to .1, .2, ... once it reaches `max_bytes`."""
+    def __init__(self, path, max_bytes=LOG_FILE_MAX_BYTES, backups=LOG_FILE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def write(self, lines):
+        """Writes already-serialized lines, rotating first if they would overflow the file."""
+        data = "".join(lines)
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        """Shifts path.N-1 -> path.N ... path -> path.1 and starts an empty file."""
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+class ServerConsole(threading.Thread):
+    """Background writer for server console output and the structured log file.
+
+    `write()` only appends to a bounded buffer, so a slow terminal, pipe or
+    disk never stalls a handler thread or the event loop. The writer thread
+    drains the buffer in batches: one write and flush per batch for the
+    console, one JSON line per record for the log file. Records arriving
+    while the buffer is full are dropped and reported once it catches up.
+    """
+    def __init__(self, stream=None, log_path=None, ansi=True, echo_chat=True,
+                 capacity=CONSOLE_BUFFER, log_max_bytes=LOG_FILE_MAX_BYTES, log_backups=LOG_FILE_BACKUPS):
+        super().__init__(daemon=True)
+        self.stream = stream if stream is not None else sys.stdout
+        self.log = RotatingJsonLog(log_path, log_max_bytes, log_backups) if log_path else None
+        self.ansi = ansi
+        self.echo_chat = echo_chat
+        self.capacity = capacity
+        self.records = deque()  # (timestamp, event, text, fields)
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closing = False
+        self.start()
+
+    def write(self, text, event='info', **fields):
+        """Queues one line of output without blocking. `fields` go only to the log file."""
+        if event == 'chat' and not self.echo_chat and self.log is None:
+            return
+        with self.cond:
+            if len(self.records) >= self.capacity:
+                self.dropped += 1
+                return
+            self.records.append((time.time(), event, text, fields))
+            if len(self.records) == 1:
+                self.cond.notify()
+
+    def run(self):
+        """Writes queued records in batches until closed."""
+        import json
+        while True:
+            with self.cond:
+                while not self.records and not self.closing:
+                    self.cond.wait()
+                if not self.records and self.closing:
+                    break
+                batch = self.records
+                self.records = deque()
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                batch.append((time.time(), 'warning', f"{COLORS['red']}[!] Console fell behind; {dropped} lines dropped.{COLORS['reset']}", {}))
+
+            lines = []
+            records = []
+            for timestamp, event, text, fields in batch:
+                if isinstance(text, bytes):
+                    # Chat lines arrive pre-encoded; decoding is deferred to this thread
+                    text = text.decode('utf-8', errors='replace')
+                plain = None
+                if event != 'chat' or self.echo_chat:
+                    if self.ansi:
+                        lines.append(text)
+                    else:
+                        plain = ANSI_PATTERN.sub('', text)
+                        lines.append(plain)
+                if self.log is not None:
+                    if plain is None:
+                        plain = ANSI_PATTERN.sub('', text)
+                    record = {'time': datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds'),
+                              'event': event, 'text': plain.strip()}
+                    record.update(fields)
+                    records.append(json.dumps(record, ensure_ascii=False) + "\n")
+            try:
+                if lines:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                if records:
+                    self.log.write(records)
+            except (OSError, ValueError):
+                # A closed terminal or full disk must not take the server down
+                pass
+
+    def close(self, timeout=5.0):
+        """Flushes what is queued, then stops the writer and closes the log file."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.join(timeout)
+        if self.log is not None:
+            self.log.close()
+
+# --- Rooms ---
+DEFAULT_ROOM = 'lobby'
+ROOM_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+ROOM_RATE_WINDOW = 60.0  # Seconds; time constant of the per-room message-rate average
+
+class RecentBuffer:
+    """Fixed-size ring of a room's last broadcast frames, ordered by sequence number.
+
+    Slots are preallocated; once `capacity` frames or `max_bytes` bytes are held
+    the oldest frames are overwritten, so memory use is strictly bounded. Frames
+    are stored already encoded and are replayed byte-for-byte.
+    """
+    def __init__(self, capacity=100, max_bytes=256 * 1024):
+        self.seqs = [0] * capacity
+        self.frames = [None] * capacity
+        self.max_bytes = max_bytes
+        self.start = 0   # Slot of the oldest frame
+        self.count = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def append(self, seq, frame):
+        """Stores a frame, evicting the oldest ones to stay within bounds."""
+        capacity = len(self.frames)
+        if not capacity or len(frame) > self.max_bytes:
+            return
+        with self.lock:
+            while self.count and (self.count == capacity or self.bytes + len(frame) > self.max_bytes):
+                self.bytes -= len(self.frames[self.start])
+                self.frames[self.start] = None
+                self.start = (self.start + 1) % capacity
+                self.count -= 1
+            slot = (self.start + self.count) % capacity
+            self.seqs[slot] = seq
+            self.frames[slot] = frame
+            self.count += 1
+            self.bytes += len(frame)
+
+    def oldest_seq(self):
+        """Returns the oldest buffered sequence number, or None if empty."""
+        with self.lock:
+            return self.seqs[self.start] if self.count else None
+
+    def since(self, seq):
+        """Returns the buffered frames with sequence number > seq, oldest first."""
+        with self.lock:
+            capacity = len(self.frames)
+            lo, hi = 0, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.seqs[(self.start + mid) % capacity] <= seq:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return [self.frames[(self.start + i) % capacity] for i in range(lo, self.count)]
+
+class Room:
+    """A chat room: its member index, recent-message ring, flood limiter and traffic statistics."""
+    def __init__(self, name, recent_size=100, recent_bytes=256 * 1024, msg_rate=0, byte_rate=0):
+        self.name = name
+        self.members = set()
+        self.recent = RecentBuffer(recent_size, recent_bytes)
+        self.limiter = FloodLimiter(msg_rate, byte_rate)
+        self.messages = 0
+        self.bytes = 0
+        self._rate = 0.0        # Exponentially decayed messages/sec
+        self._rate_time = time.monotonic()
+        self._snapshot = ()
+        self._snapshot_valid = True
+
+    def record(self, size):
+        """Accounts one message of `size` bytes fanned out in this room."""
+        now = time.monotonic()
+        self._rate = self._rate * math.exp((self._rate_time - now) / ROOM_RATE_WINDOW) + 1.0 / ROOM_RATE_WINDOW
+        self._rate_time = now
+        self.messages += 1
+        self.bytes += size
+
+    def rate(self):
+        """Returns the recent message rate in messages/sec."""
+        return self._rate * math.exp((self._rate_time - time.monotonic()) / ROOM_RATE_WINDOW)
+
+class RoomDirectory:
+    """Thread-safe room -> members index plus each client's current room.
+
+    Every client is in exactly one room; fan-out iterates a cached member tuple
+    of that room instead of scanning every connected client.
+    """
+    def __init__(self, recent_size=100, recent_bytes=256 * 1024, msg_rate=0, byte_rate=0):
+        self.recent_size = recent_size
+        self.recent_bytes = recent_bytes
+        self.msg_rate = msg_rate
+        self.byte_rate = byte_rate
+        self.rooms = {DEFAULT_ROOM: self._new_room(DEFAULT_ROOM)}  # {name: Room}
+        self.current = {}  # {socket: Room}
+        self._lock = threading.Lock()
+
+    def room_of(self, client_socket):
+        """Returns the client's current Room, or None if it is not in any."""
+        return self.current.get(client_socket)
+
+    def join(self, client_socket, name):
+        """Moves a client into a room (creating it). Returns (old_room, new_room)."""
+        with self._lock:
+            old = self.current.get(client_socket)
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = self._new_room(name)
+            if old is room:
+                return old, room
+            if old is not None:
+                self._discard(client_socket, old)
+            room.members.add(client_socket)
+            room._snapshot_valid = False
+            self.current[client_socket] = room
+            return old, room
+
+    def _new_room(self, name):
+        """Creates a room with the directory's ring and flood-limit settings."""
+        return Room(name, self.recent_size, self.recent_bytes, self.msg_rate, self.byte_rate)
+
+    def leave(self, client_socket):
+        """Removes a client from its room. Returns the room it left, or None."""
+        with self._lock:
+            room = self.current.pop(client_socket, None)
+            if room is not None:
+                self._discard(client_socket, room)
+            return room
+
+    def rebind(self, old_socket, new_socket):
+        """Moves a member to a new socket without leaving its room. Returns the room, or None."""
+        with self._lock:
+            room = self.current.pop(old_socket, None)
+            if room is not None:
+                room.members.discard(old_socket)
+                room.members.add(new_socket)
+                room._snapshot_valid = False
+                self.current[new_socket] = room
+            return room
+
+    def _discard(self, client_socket, room):
+        """Drops a member (lock held), deleting the room once it is empty."""
+        room.members.discard(client_socket)
+        room._snapshot_valid = False
+        if not room.members and room.name != DEFAULT_ROOM:
+            del self.rooms[room.name]
+
+    def members(self, room):
+        """Returns the room's cached member tuple, rebuilt only after membership changes."""
+        if not room._snapshot_valid:
+            with self._lock:
+                if not room._snapshot_valid:
+                    room._snapshot = tuple(room.members)
+                    room._snapshot_valid = True
+        return room._snapshot
+
+    def listing(self):
+        """Returns [(name, member_count, messages_per_sec, messages, bytes)] for every room."""
+        return [(room.name, len(room.members), room.rate(), room.messages, room.bytes) for room in list(self.rooms.values())]
+
+# --- Message Log ---
+# Segmented append-only log of broadcasts and PMs. Each segment is a pair of files
+# named after the first sequence number they hold:
+#   <base_seq>.log  records: header | scope (room or "sender|recipient") | text
+#   <base_seq>.idx  one fixed-size entry per record: seq | timestamp | position in .log
+# The index lets readers binary-search by sequence number or time and jump straight
+# to a record through an mmap of the segment, without loading the log into memory.
+LOG_RECORD_HEADER = struct.Struct('!IQdBH')  # body length, seq, timestamp, kind, scope length
+LOG_INDEX_ENTRY = struct.Struct('!QdQ')      # seq, timestamp, record position
+LOG_KIND_BROADCAST = 1
+LOG_KIND_PRIVATE = 2
+DEFAULT_HISTORY = 20   # Messages replayed by a bare /history
+MAX_HISTORY = 500
+HISTORY_ARG_PATTERN = re.compile(r'^(?:(\d+)([smh])?)?$')
+HISTORY_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+class LogSegment:
+    """One <base_seq>.log/.idx pair; sealed segments keep their mmaps open for reads."""
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.log_path = os.path.join(directory, f"{base_seq:020d}.log")
+        self.idx_path = os.path.join(directory, f"{base_seq:020d}.idx")
+        self.count = 0         # Number of index entries
+        self.size = 0          # Bytes of valid records in the .log file
+        self.last_seq = None
+        self._maps = None      # (log mmap, idx mmap) cached once the segment is sealed
+
+    def recover(self):
+        """Rebuilds the index from the .log file, truncating a torn record at the tail."""
+        entries = bytearray()
+        position = 0
+        with open(self.log_path, 'rb') as f:
+            data = f.read()
+        while position + LOG_RECORD_HEADER.size <= len(data):
+            body_len, seq, timestamp, _, _ = LOG_RECORD_HEADER.unpack_from(data, position)
+            end = position + LOG_RECORD_HEADER.size + body_len
+            if end > len(data):
+                break
+            entries += LOG_INDEX_ENTRY.pack(seq, timestamp, position)
+            self.last_seq = seq
+            position = end
+        with open(self.log_path, 'r+b') as f:
+            f.truncate(position)
+        with open(self.idx_path, 'wb') as f:
+            f.write(entries)
+        self.size = position
+        self.count = len(entries) // LOG_INDEX_ENTRY.size
+
+    def load(self):
+        """Reads bookkeeping for a sealed segment from its index."""
+        self.size = os.path.getsize(self.log_path)
+        self.count = os.path.getsize(self.idx_path) // LOG_INDEX_ENTRY.size
+        if self.count:
+            with open(self.idx_path, 'rb') as f:
+                f.seek((self.count - 1) * LOG_INDEX_ENTRY.size)
+                self.last_seq = LOG_INDEX_ENTRY.unpack(f.read(LOG_INDEX_ENTRY.size))[0]
+
+    def maps(self, sealed):
+        """Returns (log mmap, idx mmap) covering the segment's current contents."""
+        if self._maps is not None:
+            return self._maps
+        import mmap
+        with open(self.log_path, 'rb') as log_file, open(self.idx_path, 'rb') as idx_file:
+            maps = (mmap.mmap(log_file.fileno(), self.size, access=mmap.ACCESS_READ),
+                    mmap.mmap(idx_file.fileno(), self.count * LOG_INDEX_ENTRY.size, access=mmap.ACCESS_READ))
+        if sealed:
+            self._maps = maps
+        return maps
+
+    def close_maps(self):
+        if self._maps is not None:
+            for m in self._maps:
+                m.close()
+            self._maps = None
+
+class MessageLog:
+    """Durable, segmented append-only message log with batched fsync and mmap replay.
+
+    Records are written through a buffered file and fsynced in batches (every
+    `fsync_batch` records or `fsync_interval` seconds, by a background thread);
+    a new segment starts once the active one reaches `segment_bytes`.
+    """
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, fsync_interval=1.0,
+                 fsync_batch=256):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.lock = threading.RLock()
+        self.unsynced = 0
+        self.closed = False
+        self.sync_requested = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = []
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory)
+                       if name.endswith('.log') and name[:-4].isdigit())
+        for base in bases:
+            segment = LogSegment(directory, base)
+            if base == bases[-1] or not os.path.exists(segment.idx_path):
+                segment.recover()
+            else:
+                segment.load()
+            self.segments.append(segment)
+        self.last_seq = next((seg.last_seq for seg in reversed(self.segments) if seg.last_seq is not None), 0)
+
+        if not self.segments:
+            self.segments.append(LogSegment(directory, self.last_seq + 1))
+        self._open_active()
+
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def _open_active(self):
+        """Opens the newest segment's files for appending."""
+        active = self.segments[-1]
+        self.log_file = open(active.log_path, 'ab')
+        self.idx_file = open(active.idx_path, 'ab')
+
+    def append(self, seq, kind, scope, text, timestamp=None):
+        """Appends one record. Durable after the next batched fsync."""
+        timestamp = time.time() if timestamp is None else timestamp
+        scope_bytes = scope.encode('utf-8')
+        text_bytes = text if isinstance(text, bytes) else text.encode('utf-8')
+        header = LOG_RECORD_HEADER.pack(len(scope_bytes) + len(text_bytes), seq, timestamp, kind, len(scope_bytes))
+        with self.lock:
+            if self.closed:
+                return
+            active = self.segments[-1]
+            self.log_file.write(header + scope_bytes + text_bytes)
+            self.idx_file.write(LOG_INDEX_ENTRY.pack(seq, timestamp, active.size))
+            active.size += len(header) + len(scope_bytes) + len(text_bytes)
+            active.count += 1
+            active.last_seq = seq
+            self.last_seq = seq
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_batch:
+                # Hand the fsync to the background thread; appends never wait on the disk
+                self.sync_requested.set()
+            if active.size >= self.segment_bytes:
+                self._rotate(seq + 1)
+
+    def _rotate(self, next_seq):
+        """Seals the active segment and starts a new one (lock held)."""
+        for f in (self.log_file, self.idx_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self.unsynced = 0
+        self.log_file.close()
+        self.idx_file.close()
+        self.segments.append(LogSegment(self.directory, next_seq))
+        self._open_active()
+
+    def sync(self):
+        """Flushes buffered records and fsyncs them to disk."""
+        with self.lock:
+            if self.closed or not self.unsynced:
+                return
+            self.log_file.flush()
+            self.idx_file.flush()
+            fds = (self.log_file.fileno(), self.idx_file.fileno())
+            self.unsynced = 0
+        # fsync outside the lock so appends keep flowing while the disk catches up
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass # Segment was rotated or closed meanwhile; that path fsyncs itself
+
+    def _flush_loop(self):
+        """Background fsync: every fsync_interval, or sooner once fsync_batch records are pending."""
+        while not self.closed:
+            self.sync_requested.wait(self.fsync_interval)
+            self.sync_requested.clear()
+            try:
+                self.sync()
+            except (OSError, ValueError):
+                pass
+
+    def close(self):
+        """Syncs and closes the log."""
+        with self.lock:
+            if self.closed:
+                return
+            for f in (self.log_file, self.idx_file):
+                f.flush()
+                os.fsync(f.fileno())
+            self.closed = True
+            self.sync_requested.set()
+            self.log_file.close()
+            self.idx_file.close()
+            for segment in self.segments:
+                segment.close_maps()
+
+    def _views(self):
+        """Returns [(segment, log map, idx map)] with buffered writes made visible (lock held)."""
+        self.log_file.flush()
+        self.idx_file.flush()
+        views = []
+        for i, segment in enumerate(self.segments):
+            if segment.count:
+                log_map, idx_map = segment.maps(sealed=i < len(self.segments) - 1)
+                views.append((segment, log_map, idx_map))
+        return views
+
+    @staticmethod
+    def _read(log_map, idx_map, i):
+        """Decodes the i-th record of a segment: (seq, timestamp, kind, scope, text)."""
+        position = LOG_INDEX_ENTRY.unpack_from(idx_map, i * LOG_INDEX_ENTRY.size)[2]
+        body_len, seq, timestamp, kind, scope_len = LOG_RECORD_HEADER.unpack_from(log_map, position)
+        start = position + LOG_RECORD_HEADER.size
+        scope = log_map[start:start + scope_len].decode('utf-8', errors='replace')
+        text = log_map[start + scope_len:start + body_len].decode('utf-8', errors='replace')
+        return seq, timestamp, kind, scope, text
+
+    @staticmethod
+    def _search(idx_map, count, key, field):
+        """Binary-searches a segment index for the first entry whose field >= key."""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if LOG_INDEX_ENTRY.unpack_from(idx_map, mid * LOG_INDEX_ENTRY.size)[field] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def seek_time(self, timestamp):
+        """Returns the sequence number of the first record at or after timestamp."""
+        with self.lock:
+            if self.closed:
+                return self.last_seq + 1
+            for segment, _, idx_map in self._views():
+                i = self._search(idx_map, segment.count, timestamp, 1)
+                if i < segment.count:
+                    return LOG_INDEX_ENTRY.unpack_from(idx_map, i * LOG_INDEX_ENTRY.size)[0]
+            return self.last_seq + 1
+
+    def tail(self, count, match=None, scan_limit=100000, start=0, end=None, counted=False):
+        """Returns the last `count` matching records with start <= seq < end (oldest first), scanning backwards.
+
+        With `counted`, returns (records, matches): the scan goes on to `start`
+        (or `scan_limit`) to count every matching record, including those left out.
+        """
+        with self.lock:
+            if self.closed:
+                return ([], 0) if counted else []
+            records = []
+            matches = scanned = 0
+            for segment, log_map, idx_map in reversed(self._views()):
+                if end is not None and segment.base_seq >= end:
+                    continue
+                first = self._search(idx_map, segment.count, start, 0)
+                last = segment.count if end is None else self._search(idx_map, segment.count, end, 0)
+                for i in range(last - 1, first - 1, -1):
+                    record = self._read(log_map, idx_map, i)
+                    scanned += 1
+                    if match is None or match(record):
+                        matches += 1
+                        if len(records) < count:
+                            records.append(record)
+                        elif not counted:
+                            return records[::-1]
+                    if scanned >= scan_limit:
+                        break
+                if first > 0 or scanned >= scan_limit:
+                    break  # Reached `start`; older segments hold nothing in range
+            return (records[::-1], matches) if counted else records[::-1]
+
+# --- Message Formatting ---
+FRAME_FIELDS_SEPARATOR = b'\0'
+
+class TimestampCache:
+    """Local "HH:MM:SS" as text and bytes, formatted at most once per second."""
+    def __init__(self):
+        self.current = (None, '', b'')  # (second, text, bytes), swapped atomically
+
+    def now(self):
+        """Returns (text, bytes) for the current second."""
+        second = int(time.time())
+        current = self.current
+        if current[0] != second:
+            text = time.strftime("%H:%M:%S", time.localtime(second))
+            current = self.current = (second, text, text.encode('ascii'))
+        return current[1], current[2]
+
+class MessageTemplate:
+    """Pre-encoded pieces of one user's chat lines, built once per session.
+
+    A chat line is `head + timestamp + tail + message`, so formatting a
+    message costs a few byte concatenations instead of an f-string with
+    colour lookups followed by an encode.
+    """
+    __slots__ = ('username', 'user_color', 'arrow_color', 'head', 'tail', 'fields',
+                 'colored_name', 'pm_tail', 'pm_arrow')
+
+    def __init__(self, username, user_color, arrow_color):
+        self.username = username
+        self.user_color = user_color
+        self.arrow_color = arrow_color
+        self.head = f"{COLORS[user_color]}[".encode('utf-8')
+        self.tail = f" {username}]{COLORS['reset']} {COLORS[arrow_color]}»{COLORS['reset']} ".encode('utf-8')
+        # Sender fields of a FRAME_FIELDS payload, for clients that render colours themselves
+        self.fields = FRAME_FIELDS_SEPARATOR.join(
+            (username.encode('utf-8'), user_color.encode('ascii'), arrow_color.encode('ascii'), b''))
+        self.colored_name = f"{COLORS[user_color]}{username}{COLORS['reset']}"
+        self.pm_tail = f"] {username} {COLORS[user_color]}->{COLORS['reset']} "
+        self.pm_arrow = f"] {COLORS[user_color]}->{COLORS['reset']} "
+
+    def render(self, timestamp_bytes, message_bytes):
+        """Returns the complete rendered chat line as bytes."""
+        return b''.join((self.head, timestamp_bytes, self.tail, message_bytes))
+
+# --- Mentions ---
+MENTION_PATTERN = re.compile(r'@([a-zA-Z0-9_]+)')
+
+class MentionIndex:
+    """Index of online usernames used to highlight @mentions and collect who was mentioned.
+
+    Highlight strings are built once when a user joins, so rendering a message is
+    a single scan with dict lookups and no per-message closures or socket I/O.
+    """
+    def __init__(self):
+        self.highlights = {}  # {username: (socket, colored "@username")}
+
+    def add(self, username, client_socket, color):
+        """Indexes a newly registered user."""
+        self.highlights[username] = (client_socket, f"{COLORS[color]}@{username}{COLORS['reset']}")
+
+    def remove(self, username, client_socket):
+        """Drops a user from the index (only if the name still belongs to that socket)."""
+        hit = self.highlights.get(username)
+        if hit is not None and hit[0] is client_socket:
+            del self.highlights[username]
+
+    def render(self, message):
+        """Returns (message with mentions highlighted, set of mentioned sockets)."""
+        if '@' not in message:
+            return message, ()
+        lookup = self.highlights.get
+        parts = []
+        mentioned = set()
+        last = 0
+        for match in MENTION_PATTERN.finditer(message):
+            hit = lookup(match.group(1))
+            if hit is None:
+                continue # Unknown user: leave as-is
+            parts.append(message[last:match.start()])
+            parts.append(hit[1])
+            mentioned.add(hit[0])
+            last = match.end()
+        if not mentioned:
+            return message, ()
+        parts.append(message[last:])
+        return ''.join(parts), mentioned
+
+class ClientWriter(threading.Thread):
+    """Drains one client's OutboundQueue in the thread engine so senders never block on it."""
+    def __init__(self, server, client_socket, queue):
+        super().__init__(daemon=True)
+        self.server = server
+        self.client_socket = client_socket
+        self.queue = queue
+        self.cond = threading.Condition()
+        self.closing = False
+
+    def push(self, data, droppable=False):
+        """Queues a frame for the writer. Returns False if the client should be disconnected."""
+        with self.cond:
+            if self.closing:
+                return True
+            accepted = self.queue.push(data, droppable)
+            self.cond.notify()
+        return accepted
+
+    def close(self, drain=True):
+        """Stops the writer once the queue is drained (or immediately if drain is False)."""
+        with self.cond:
+            self.closing = True
+            if not drain:
+                self.queue.clear()
+            self.cond.notify()
+
+    def run(self):
+        """Writes batches of queued frames, then shuts the socket down when closed."""
+        failed = False
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                batch = self.queue.take()
+            try:
+                while batch:
+                    sent = write_buffers(self.client_socket, batch)
+                    while sent:
+                        if sent < len(batch[0]):
+                            batch[0] = memoryview(batch[0])[sent:]
+                            break
+                        sent -= len(batch.pop(0))
+            except OSError:
+                failed = True
+                break
+
+        if failed:
+            if self.server.metrics is not None:
+                self.server.metrics.inc('vchat_send_errors_total')
+            with self.cond:
+                self.queue.clear()
+            # If sending fails, assume the client is disconnected
+            self.server.remove_client(self.client_socket)
+        try:
+            # shutdown() also wakes the reader thread blocked in recv()
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.client_socket.close()
+        except OSError:
+            pass
+
+class ChatServer:
+    """Thread-per-client chat server (the original 'thread' engine)."""
+    def __init__(self, host, port, username, user_color, arrow_color, backlog=10,
+                 send_queue_size=1024, send_queue_bytes=1024 * 1024, slow_consumer='coalesce',
+                 log_dir=None, log_segment_bytes=16 * 1024 * 1024,
+                 recent_size=100, recent_bytes=256 * 1024,
+                 reuse_port=False, relay_path=None, shard_id=None, banner=True,
+                 rate_limit=0, byte_limit=0, room_rate_limit=0, room_byte_limit=0,
+                 max_message_size=MAX_FRAME_SIZE, metrics=False, metrics_host='127.0.0.1', metrics_port=None,
+                 admins=(), log_file=None, headless=False,
+                 heartbeat_interval=30.0, idle_timeout=90.0, handshake_timeout=10.0, keepalive=60,
+                 resume_grace=60.0, compression_level=6, tls_cert=None, tls_key=None, console_stream=None):
+        # Console and structured log output go through a background writer thread
+        self.console = ServerConsole(console_stream, log_path=log_file, ansi=not headless, echo_chat=not headless)
+        self.running = True
+        banner = banner and not headless
+        self.registry = ClientRegistry()
+        self.mentions = MentionIndex()
+        self.clock = TimestampCache()
+        self.templates = {}  # {socket: MessageTemplate}, built at handshake
+        self.structured = set()  # Sockets that asked for unrendered FRAME_FIELDS broadcasts
+        self.local_sounds = set()  # Structured sockets that pick broadcast sounds themselves (no FRAME_SOUND)
+        self.rooms = RoomDirectory(recent_size, recent_bytes, room_rate_limit, room_byte_limit)
+        # Flood protection: per-client token buckets (0 disables a limit) and a frame size cap
+        self.rate_limit = rate_limit
+        self.byte_limit = byte_limit
+        self.max_message_size = max_message_size
+        self.limiters = {}  # {socket: FloodLimiter}
+        # Optional instrumentation; None keeps every hook down to one attribute test
+        self.metrics = Metrics(self.metric_gauges) if metrics or metrics_port else None
+        self.admins = frozenset(admins)  # Usernames allowed to run /stats (loopback clients if empty)
+        # Dead-peer detection: application pings and timeouts on one timer wheel, plus TCP keepalive
+        self.heartbeat = (Heartbeat(heartbeat_interval, idle_timeout, handshake_timeout)
+                          if heartbeat_interval or idle_timeout or handshake_timeout else None)
+        self.keepalive = keepalive
+        self.compression_level = compression_level  # zlib level offered to 'deflate' clients; 0 refuses
+        self.tls = server_tls_context(tls_cert, tls_key) if tls_cert else None
+        # Resumable sessions: {token: [socket, parked_until or None while connected]}. A dropped
+        # client's entry stays registered under its dead socket until it resumes or the grace ends
+        self.resume_grace = resume_grace
+        self.sessions = {}
+        self.session_tokens = {}  # {socket: token}
+        self.session_lock = threading.Lock()
+        self.parked_wheel = TimerWheel()
+        self.timers_enabled = self.heartbeat is not None or bool(resume_grace)
+        # Optional durable history; sequence numbers continue across restarts
+        self.log = MessageLog(log_dir, segment_bytes=log_segment_bytes) if log_dir else None
+        self.seq = itertools.count((self.log.last_seq if self.log else 0) + 1)
+        # Keeps sequence order identical in rings and the log, and orders room joins against
+        # broadcasts (re-entrant: a failed send under it may broadcast a leave notice)
+        self.seq_lock = threading.RLock()
+        self.writers = {}  # {socket: ClientWriter} (thread engine only)
+        self.send_queue_size = send_queue_size
+        self.send_queue_bytes = send_queue_bytes
+        self.slow_consumer = slow_consumer
         self.username = username
         self.user_color = user_color
         self.arrow_color = arrow_color
@@ -130,9 +1846,60 @@ class ChatServer:
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Allows reuse of the port after the server is stopped
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Shard workers share the port; the kernel spreads connections across them
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind((host, port))
-        self.server.listen(10)
+        self.server.listen(backlog)
+        
+        if banner:
+            self.print_server_banner(host, port)
+        
+        # Add server's own information to the user list for full functionality
+        self.server_socket = socket.socket() # Dummy socket for server's own data
+        self.registry.register(self.server_socket, username, user_color, arrow_color)
+        self.templates[self.server_socket] = MessageTemplate(username, user_color, arrow_color)
+        self.mentions.add(username, self.server_socket, user_color)
+
+        # Users connected to other shard workers: {username: [user_color, arrow_color, room]}
+        self.remote_users = {}
+        self.shard_id = shard_id
+        self.relay = ShardRelay(self, relay_path, shard_id) if relay_path else None
         
+        if metrics_port:
+            self.metrics.serve(metrics_host, metrics_port)
+            if banner:
+                self.console.write(f"{COLORS['blue']}[*]{COLORS['reset']} Metrics at http://{metrics_host}:{metrics_port}/metrics")
+
+        if banner:
+            self.console.write(f"\n{COLORS['blue']}[*]{COLORS['reset']} Server running as {COLORS[user_color]}[{username}]{COLORS['reset']}...")
+
+    @property
+    def address(self):
+        """The (host, port) actually listened on; useful after binding port 0."""
+        return self.server.getsockname()[:2]
+
+    def start(self):
+        """Runs the server in a background thread, for embedding in tests and tools. Returns self."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """Stops a server started with start(): disconnects everyone and closes the listener."""
+        self.running = False
+        host, port = self.address
+        try:
+            # Wake the accept loop (or selector) so it sees the flag
+            socket.create_connection(('127.0.0.1' if host == '0.0.0.0' else host, port), timeout=1).close()
+        except OSError:
+            pass
+        thread = getattr(self, 'thread', None)
+        if thread is not None:
+            thread.join(timeout)
+
+    def print_server_banner(self, host, port):
+        """Prints the server's connection details."""
         local_ip = get_local_ip()
         
         print(f"\n{COLORS['blue']}╔══════════════════════════════════════════╗")
@@ -143,207 +1910,841 @@ class ChatServer:
         print(f"║ {COLORS['green']}Port:      {port:<30}{COLORS['blue']}║")
         print(f"║ {COLORS['yellow']}Share the IP/Port above with clients!{COLORS['blue']}║")
         print(f"╚══════════════════════════════════════════╝{COLORS['reset']}")
-        
-        # Add server's own information to the user list for full functionality
-        self.server_socket = socket.socket() # Dummy socket for server's own data
-        self.clients[self.server_socket] = (username, user_color, arrow_color)
-        self.usernames[username] = self.server_socket
-        
-        print(f"\n{COLORS['blue']}[*]{COLORS['reset']} Server running as {COLORS[user_color]}[{username}]{COLORS['reset']}...")
 
-    def process_mentions(self, message, current_socket):
-        """Handle @mentions by highlighting the username."""
-        
-        def replace_mention(match):
-            mentioned_user = match.group(1)
-            # Find the mentioned user's color for highlighting
-            mentioned_sock = self.usernames.get(mentioned_user)
-            if mentioned_sock and mentioned_sock in self.clients:
-                mentioned_color = self.clients[mentioned_sock][1]
-                # Send sound command to the mentioned client
-                if mentioned_sock != self.server_socket:
-                    try:
-                        mentioned_sock.send("PLAY_SOUND|mention".encode('utf-8'))
-                    except Exception:
-                        pass
-                
-                return f"{COLORS[mentioned_color]}@{mentioned_user}{COLORS['reset']}"
-            return match.group(0) # If user not found, return as-is
+    def apply_relay(self, frame_type, fields):
+        """Applies an event relayed from another shard worker."""
+        if frame_type == RELAY_JOIN:
+            username, user_color, arrow_color, room = fields[:4]
+            if user_color in COLORS and arrow_color in COLORS:
+                self.remote_users[username] = [user_color, arrow_color, room]
+                self.mentions.add(username, None, user_color)
+        elif frame_type == RELAY_LEAVE:
+            if self.remote_users.pop(fields[0], None) is not None:
+                self.mentions.remove(fields[0], None)
+        elif frame_type == RELAY_ROOM:
+            if fields[0] in self.remote_users:
+                self.remote_users[fields[0]][2] = fields[1]
+        elif frame_type == RELAY_BROADCAST:
+            if len(fields) != 5:
+                return
+            room_name, username, user_color, arrow_color, message = fields
+            room = self.rooms.rooms.get(room_name)
+            if room is not None and room.members:
+                sender = None
+                if user_color in COLORS and arrow_color in COLORS:
+                    # A user's chat line: rendered here from the author's fields
+                    sender = MessageTemplate(username, user_color, arrow_color)
+                self.broadcast(message, room=room, relayed=True, sender=sender)
+        elif frame_type == RELAY_PRIVATE:
+            if len(fields) != 4:
+                return
+            recipient_name, sender_name, sender_color, message = fields
+            recipient_socket = self.registry.socket_for(recipient_name)
+            if recipient_socket is not None and sender_color in COLORS:
+                sender = MessageTemplate(sender_name, sender_color, sender_color)
+                recipient_msg, _ = self.format_private(sender, recipient_name, message)
+                self.deliver_private(recipient_socket, recipient_name, recipient_msg)
+        elif frame_type == RELAY_REJECT:
+            client_socket = self.registry.socket_for(fields[0])
+            if client_socket is not None and client_socket != self.server_socket:
+                self.send_to(client_socket, f"{COLORS['red']}[!] Username '{fields[0]}' already taken. Disconnecting.{COLORS['reset']}")
+                self.remove_client(client_socket, resumable=False)
+
+    def forget_remote_users(self):
+        """Drops every user known only through the relay."""
+        for username in list(self.remote_users):
+            self.remote_users.pop(username, None)
+            self.mentions.remove(username, None)
+
+    def format_private(self, sender, recipient_name, message):
+        """Returns (recipient_msg, sender_msg) for a private message from a MessageTemplate."""
+        timestamp, _ = self.clock.now()
         
-        return re.sub(r'@([a-zA-Z0-9_]+)', replace_mention, message)
+        # Message for the recipient
+        recipient_msg = f"{COLORS['yellow']}[PM @{timestamp}{sender.pm_tail}{message}"
+        # Message confirmation for the sender
+        sender_msg = f"{COLORS['purple']}[PM to {recipient_name} @{timestamp}{sender.pm_arrow}{message}"
+        return recipient_msg, sender_msg
+
+    def deliver_private(self, recipient_socket, recipient_name, recipient_msg):
+        """Delivers a rendered PM to a local recipient."""
+        if recipient_socket != self.server_socket:
+            self.send_to(recipient_socket, recipient_msg)
+            # Play sound for recipient
+            self.send_raw(recipient_socket, SOUND_MENTION_FRAME, droppable=True)
+        else:
+             # If server is recipient (i.e., server is sending PM to itself)
+            self.console.write(recipient_msg, 'chat', kind='private', to=recipient_name)
 
     def send_private(self, sender_socket, recipient_name, message):
         """Handles private messages between users."""
-        if recipient_name not in self.usernames:
+        recipient_socket = self.registry.socket_for(recipient_name)
+        remote = recipient_socket is None and self.relay is not None and recipient_name in self.remote_users
+        if recipient_socket is None and not remote:
             # Send error message back to sender
-            sender_socket.send(f"{COLORS['red']}[!] User '{recipient_name}' not found.{COLORS['reset']}".encode('utf-8'))
+            self.send_to(sender_socket, f"{COLORS['red']}[!] User '{recipient_name}' not found.{COLORS['reset']}")
             return
 
-        sender_name, sender_color, _, = self.clients[sender_socket]
-        recipient_socket = self.usernames[recipient_name]
-        
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        
-        # Message for the recipient
-        recipient_msg = f"{COLORS['yellow']}[PM @{timestamp}] {sender_name} {COLORS[sender_color]}->{COLORS['reset']} {message}"
-        # Message confirmation for the sender
-        sender_msg = f"{COLORS['purple']}[PM to {recipient_name} @{timestamp}] {COLORS[sender_color]}->{COLORS['reset']} {message}"
+        sender = self.templates.get(sender_socket)
+        if sender is None:
+            return
+        sender_name = sender.username
+        message = message.replace('\0', '')  # As in broadcast(): NUL is the relay field separator
+        recipient_msg, sender_msg = self.format_private(sender, recipient_name, message)
+        if self.metrics is not None:
+            self.metrics.inc('vchat_private_messages_total')
+
+        if self.log is not None:
+            with self.seq_lock:
+                self.log.append(next(self.seq), LOG_KIND_PRIVATE, f"{sender_name}|{recipient_name}", recipient_msg)
         
         try:
-            if recipient_socket != self.server_socket:
-                recipient_socket.send(recipient_msg.encode('utf-8'))
-                # Play sound for recipient
-                recipient_socket.send("PLAY_SOUND|mention".encode('utf-8'))
+            if remote:
+                # The hub routes it to the shard that owns the recipient
+                self.relay.publish(RELAY_PRIVATE, recipient_name, sender_name, sender.user_color, message)
             else:
-                 # If server is recipient (i.e., server is sending PM to itself)
-                print(recipient_msg)
+                self.deliver_private(recipient_socket, recipient_name, recipient_msg)
             
             # Send confirmation back to sender (unless sender is server itself)
             if sender_socket != self.server_socket:
-                sender_socket.send(sender_msg.encode('utf-8'))
+                self.send_to(sender_socket, sender_msg)
             else:
-                 print(sender_msg)
+                 self.console.write(sender_msg, 'chat', kind='private', to=recipient_name)
                  
         except Exception as e:
-            print(f"{COLORS['red']}[!] PM send error for {recipient_name}: {e}{COLORS['reset']}")
+            self.console.write(f"{COLORS['red']}[!] PM send error for {recipient_name}: {e}{COLORS['reset']}", 'error')
             # If recipient socket fails, remove them
             self.remove_client(recipient_socket)
 
-    def broadcast(self, message, exclude_socket=None):
-        """Sends a message to all connected clients."""
-        processed_msg = self.process_mentions(message, exclude_socket)
-        
-        # Print to server console
-        if exclude_socket != self.server_socket:
-            print(processed_msg)
+    def broadcast(self, message, exclude_socket=None, room=None, relayed=False, sender=None):
+        """Sends a message to every member of `room`, or to all connected clients if room is None.
+
+        With a `sender` MessageTemplate, `message` is that user's chat text and
+        the line is assembled from the template's pre-encoded segments; clients
+        that asked for structured messages get the unrendered fields instead.
+        Room broadcasts are also published to other shard workers, unless the
+        message itself came from the relay (`relayed`).
+        """
+        started = time.perf_counter() if self.metrics is not None else 0.0
+        if sender is not None and '\0' in message:
+            # NUL separates FRAME_FIELDS and relay fields; user text must not contain it
+            message = message.replace('\0', '')
+        processed_msg, mentioned = self.mentions.render(message)
+
+        if room is not None and self.relay is not None and not relayed:
+            if sender is not None:
+                self.relay.publish(RELAY_BROADCAST, room.name, sender.username, sender.user_color, sender.arrow_color, message)
+            else:
+                self.relay.publish(RELAY_BROADCAST, room.name, '', '', '', message)
+
+        # Encode once: every recipient queues the same immutable frame, and
+        # the room's ring keeps it for catch-up without re-encoding
+        text_bytes = processed_msg.encode('utf-8')
+        if sender is not None:
+            _, timestamp = self.clock.now()
+            text_bytes = sender.render(timestamp, text_bytes)
+        with self.seq_lock:
+            seq = next(self.seq)
+            frame = encode_chat_frame(seq, text_bytes)
+            if room is not None:
+                room.recent.append(seq, frame)
+            if self.log is not None:
+                self.log.append(seq, LOG_KIND_BROADCAST, room.name if room else '*', text_bytes)
+            # Members as of this sequence number: a client joining later gets the
+            # frame from the ring snapshot instead, never both
+            targets = self.rooms.members(room) if room is not None else self.registry.sockets()
+
+        # A resumable client still counts its own lines and notices as seen, so a
+        # resume does not replay them back to it
+        if exclude_socket is not None and exclude_socket in self.session_tokens:
+            self.send_raw(exclude_socket, FRAME_HEADER.pack(CHAT_SEQ.size, FRAME_SEQ) + CHAT_SEQ.pack(seq))
+
+        # Echo to the server console (relayed messages were echoed by their own shard)
+        if exclude_socket != self.server_socket and not relayed:
+            self.console.write(text_bytes, 'chat', kind='broadcast', room=room.name if room else '*', seq=seq)
 
-        # Send to all clients
-        for client_socket in list(self.clients.keys()):
+        structured = self.structured if sender is not None else ()
+        local_sounds = self.local_sounds if sender is not None else ()
+        if structured:
+            fields_frame = encode_chat_frame(
+                seq, timestamp + FRAME_FIELDS_SEPARATOR + sender.fields + message.encode('utf-8'), FRAME_FIELDS)
+
+        if room is not None:
+            room.record(len(frame))
+
+        # Send to all recipients
+        for client_socket in targets:
             # Do not send to the server's dummy socket or the excluded socket
             if client_socket != exclude_socket and client_socket != self.server_socket:
                 try:
-                    client_socket.send(processed_msg.encode('utf-8'))
-                    # Send generic notification sound trigger
-                    client_socket.send("PLAY_SOUND|notify".encode('utf-8'))
+                    self.send_raw(client_socket, fields_frame if client_socket in structured else frame)
+                    if client_socket in local_sounds:
+                        continue  # It spots mentions in the fields and sounds on its own
+                    # Mentioned users get the mention sound instead of the generic one
+                    sound = SOUND_MENTION_FRAME if client_socket in mentioned else SOUND_NOTIFY_FRAME
+                    self.send_raw(client_socket, sound, droppable=True)
                 except Exception:
                     # If sending fails, assume the client is disconnected
+                    if self.metrics is not None:
+                        self.metrics.inc('vchat_send_errors_total')
                     self.remove_client(client_socket)
 
-    def remove_client(self, client_socket, graceful=False):
-        """Handles client disconnections and informs others."""
-        if client_socket in self.clients and client_socket != self.server_socket:
-            username, _, _ = self.clients[client_socket]
-            timestamp = datetime.now().strftime("%H:%M:%S")
+        if self.metrics is not None:
+            self.metrics.inc('vchat_broadcasts_total')
+            self.metrics.observe('vchat_broadcast_fanout_seconds', time.perf_counter() - started)
+
+    def remove_client(self, client_socket, graceful=False, resumable=True):
+        """Handles client disconnections and informs others.
+
+        An unexpected drop of a client holding a resume token only parks its
+        session: the socket is closed but the user stays registered, in its
+        room, until it resumes or the grace period runs out.
+        """
+        if client_socket == self.server_socket:
+            return
+        if not graceful and resumable and self.resume_grace and self.park_session(client_socket):
+            return
+
+        with self.session_lock:
+            token = self.session_tokens.pop(client_socket, None)
+            if token is not None:
+                self.sessions.pop(token, None)
+
+        # Unregister first: only one thread wins, and a failing send during the
+        # leave broadcast cannot recurse back into this client
+        entry = self.registry.unregister(client_socket)
+        room = self.rooms.leave(client_socket)
+        self.limiters.pop(client_socket, None)
+        self.templates.pop(client_socket, None)
+        self.structured.discard(client_socket)
+        self.local_sounds.discard(client_socket)
+        if entry is not None:
+            username = entry[0]
+            if self.metrics is not None:
+                self.metrics.inc('vchat_disconnects_total', label='reason="graceful"' if graceful else 'reason="unexpected"')
+            self.mentions.remove(username, client_socket)
+            if self.relay is not None:
+                self.relay.publish(RELAY_LEAVE, username)
+            timestamp, _ = self.clock.now()
             leave_msg = f"{COLORS['yellow']}[{timestamp}] {username} has {'left gracefully' if graceful else 'disconnected unexpectedly'}.{COLORS['reset']}"
             
-            self.broadcast(leave_msg, exclude_socket=client_socket)
+            self.broadcast(leave_msg, exclude_socket=client_socket, room=room)
+
+        self.close_client_socket(client_socket)
+
+    def park_session(self, client_socket):
+        """Holds a dropped client's session for resume_grace seconds. Returns False if it has none."""
+        with self.session_lock:
+            session = self.sessions.get(self.session_tokens.get(client_socket))
+            if session is None or client_socket not in self.registry:
+                return False
+            first = session[1] is None
+            if first:
+                session[1] = time.monotonic() + self.resume_grace
+                self.parked_wheel.schedule(self.session_tokens[client_socket], session[1])
+        self.close_client_socket(client_socket)
+        if first:
+            if self.metrics is not None:
+                self.metrics.inc('vchat_sessions_parked_total')
+            username = (self.registry.get(client_socket) or ('?',))[0]
+            self.console.write(f"{COLORS['yellow']}[*] {username} lost connection; holding the session for {self.resume_grace:g}s.{COLORS['reset']}", 'parked', user=username)
+        return True
+
+    def expire_sessions(self):
+        """Finally removes parked sessions whose grace period has run out."""
+        now = time.monotonic()
+        expired = []
+        with self.session_lock:
+            for token in self.parked_wheel.advance(now):
+                session = self.sessions.get(token)
+                if session is not None and session[1] is not None and session[1] <= now:
+                    del self.sessions[token]
+                    self.session_tokens.pop(session[0], None)
+                    expired.append(session[0])
+        for client_socket in expired:
+            self.remove_client(client_socket, resumable=False)
+
+    def issue_session(self, client_socket):
+        """Creates a resume token for a connected client and sends it."""
+        import secrets
+        token = secrets.token_urlsafe(18)
+        with self.session_lock:
+            self.sessions[token] = [client_socket, None]
+            self.session_tokens[client_socket] = token
+        self.send_raw(client_socket, encode_frame(FRAME_SESSION, token))
+
+    def resume_session(self, client_socket, username, token, capabilities, since):
+        """Reattaches a parked (or not yet noticed dead) session to a new socket. Returns False if the token is unusable."""
+        with self.session_lock:
+            session = self.sessions.get(token)
+            if session is None or (self.registry.get(session[0]) or ('',))[0] != username:
+                return False
+            del self.sessions[token]
+            old_socket = session[0]
+            self.session_tokens.pop(old_socket, None)
+
+        entry = self.registry.rebind(old_socket, client_socket)
+        if entry is None:
+            return False
+        room = self.rooms.rebind(old_socket, client_socket)
+        _, user_color, arrow_color = entry
+        self.templates[client_socket] = self.templates.pop(old_socket, None) or MessageTemplate(username, user_color, arrow_color)
+        self.structured.discard(old_socket)
+        self.local_sounds.discard(old_socket)
+        if 'structured' in capabilities:
+            self.structured.add(client_socket)
+            if 'localsound' in capabilities:
+                self.local_sounds.add(client_socket)
+        self.mentions.add(username, client_socket, user_color)
+        limiter = self.limiters.pop(old_socket, None)
+        if limiter is not None:
+            self.limiters[client_socket] = limiter
+        # The old connection may still look alive (the client noticed the drop first)
+        self.close_client_socket(old_socket)
+        if self.metrics is not None:
+            self.metrics.inc('vchat_sessions_resumed_total')
+        self.console.write(f"{COLORS['green']}[*] {username} resumed their session.{COLORS['reset']}", 'resumed', user=username)
+
+        self.issue_session(client_socket)
+        self.send_to(client_socket, f"{COLORS['green']}[*] Session resumed, {username}.{COLORS['reset']}")
+        if room is not None and since is not None:
+            self.replay_since(client_socket, since)
+        elif room is not None:
+            self.send_catch_up(client_socket, room, room.recent.since(0))
+        return True
+
+    def enable_compression(self, client_socket):
+        """Switches a client's outbound stream to deflate (see OutboundQueue.start_compression)."""
+        writer = self.writers.get(client_socket)
+        if writer is None:
+            return
+        with writer.cond:
+            writer.queue.start_compression(self.compression_level)
+            writer.cond.notify()
+        if self.metrics is not None:
+            self.metrics.inc('vchat_compressed_connections_total')
+
+    def send_to(self, client_socket, text):
+        """Sends text to a single client as a FRAME_TEXT frame."""
+        self.send_raw(client_socket, encode_frame(FRAME_TEXT, text))
+
+    def new_send_queue(self):
+        """Creates a bounded outbound queue using the server's slow-consumer settings."""
+        return OutboundQueue(self.send_queue_size, self.send_queue_bytes, self.slow_consumer)
+
+    def send_raw(self, client_socket, data, droppable=False):
+        """Queues already-encoded frames on the client's writer thread."""
+        writer = self.writers.get(client_socket)
+        if writer is None:
+            return
+        if self.metrics is not None:
+            self.metrics.inc('vchat_frames_out_total')
+            self.metrics.inc('vchat_bytes_out_total', len(data))
+        if not writer.push(data, droppable):
+            if self.metrics is not None:
+                self.metrics.inc('vchat_slow_consumer_disconnects_total')
+            self.console.write(f"{COLORS['red']}[!] Disconnecting slow client ({(self.registry.get(client_socket) or ('?',))[0]}).{COLORS['reset']}", 'warning')
+            writer.close(drain=False)
+            self.remove_client(client_socket)
+
+    def close_client_socket(self, client_socket):
+        """Closes a client socket, ignoring errors from already-dead peers."""
+        if self.heartbeat is not None:
+            self.heartbeat.forget(client_socket)
+        writer = self.writers.pop(client_socket, None)
+        if writer is not None:
+            # The writer drains what is queued, then shuts the socket down
+            writer.close()
+            return
+        try:
+            client_socket.close()
+        except Exception:
+            pass
+
+    def register_client(self, client_socket, frame_type, init_data):
+        """Validates the handshake and registers the client. Returns False if rejected."""
+        # 1. Initial Handshake: username and color preferences
+        if frame_type != FRAME_HANDSHAKE:
+            raise ValueError("Expected handshake frame")
+        if not init_data:
+            raise ValueError("Empty handshake data")
             
-            # Clean up the dictionaries
-            if username in self.usernames:
-                del self.usernames[username]
-            del self.clients[client_socket]
+        if '\0' in init_data:
+            raise ValueError("NUL in handshake")  # Field separator in FRAME_FIELDS and relay frames
+        parts = init_data.split('|')
+        if len(parts) not in (3, 4):
+            raise ValueError("Invalid handshake format")
             
-            try:
-                client_socket.close()
-            except:
-                pass
+        client_username, client_user_color, client_arrow_color = parts[:3]
+        capabilities = parts[3].split(',') if len(parts) == 4 else ()
+        if client_user_color not in COLORS or client_arrow_color not in COLORS:
+            raise ValueError("Unknown color in handshake")
 
-    def handle_client(self, client_socket, addr):
-        """Manages the connection and message flow for a single client."""
-        try:
-            # 1. Initial Handshake: Receive username and color preferences
-            init_data = client_socket.recv(1024).decode('utf-8')
-            if not init_data:
-                raise ValueError("Empty handshake data")
-                
-            parts = init_data.split('|')
-            if len(parts) != 3:
-                raise ValueError("Invalid handshake format")
-                
-            client_username, client_user_color, client_arrow_color = parts
+        if self.tls is not None and self.metrics is not None:
+            self.metrics.inc('vchat_tls_clients_total', label=f'resumed="{str(client_socket.session_reused).lower()}"')
+
+        # Nothing has been queued to this socket yet, so the ack is the first frame it gets
+        if 'deflate' in capabilities and self.compression_level:
+            self.enable_compression(client_socket)
+
+        # Reconnecting clients send "resume=<token>" and "since=<last seq>": one round trip
+        options = dict(cap.split('=', 1) for cap in capabilities if '=' in cap)
+        if 'resume' in options and self.resume_grace:
+            since = int(options['since']) if SEQ_PATTERN.match(options.get('since', '')) else None
+            if self.resume_session(client_socket, client_username, options['resume'], capabilities, since):
+                return True
+            if client_username in self.remote_users:
+                # Parked on another worker: sessions are not shared between workers, and
+                # SO_REUSEPORT may send the next connection to the one that has it
+                self.send_raw(client_socket, RETRY_FRAME)
+                return False
+        
+        # 2. Atomically claim the username and register the client (the relay hub
+        #    settles the rare case of two shards claiming the same name at once)
+        if client_username in self.remote_users or not self.registry.register(client_socket, client_username, client_user_color, client_arrow_color):
+            self.send_to(client_socket, f"{COLORS['red']}[!] Username '{client_username}' already taken. Disconnecting.{COLORS['reset']}")
+            return False
+        self.templates[client_socket] = MessageTemplate(client_username, client_user_color, client_arrow_color)
+        if 'structured' in capabilities:
+            self.structured.add(client_socket)
+            if 'localsound' in capabilities:
+                self.local_sounds.add(client_socket)
+        self.mentions.add(client_username, client_socket, client_user_color)
+        if self.rate_limit or self.byte_limit:
+            self.limiters[client_socket] = FloodLimiter(self.rate_limit, self.byte_limit)
+
+        # 3. Send welcome message, then join the lobby and queue its recent messages straight
+        #    from the ring; under seq_lock, so each broadcast is either in that snapshot or
+        #    sent live after it
+        shard_note = f" (shard {self.shard_id})" if self.shard_id is not None else ""
+        welcome_msg = f"{COLORS['green']}[*] Welcome to V-Chat, {client_username}!{shard_note} Type /help for commands.{COLORS['reset']}"
+        self.send_to(client_socket, welcome_msg)
+        if self.resume_grace and ('resume' in capabilities or 'resume' in options):
+            self.issue_session(client_socket)
+        with self.seq_lock:
+            _, lobby = self.rooms.join(client_socket, DEFAULT_ROOM)
+            self.send_catch_up(client_socket, lobby, lobby.recent.since(0))
+        if self.relay is not None:
+            self.relay.publish(RELAY_JOIN, client_username, client_user_color, client_arrow_color, DEFAULT_ROOM)
+
+        # 4. Broadcast join message to the lobby
+        timestamp, _ = self.clock.now()
+        join_msg = f"{COLORS['yellow']}[{timestamp}] {client_username} has joined the chat!{COLORS['reset']}"
+        self.broadcast(join_msg, exclude_socket=client_socket, room=lobby)
+        return True
+
+    def send_catch_up(self, client_socket, room, frames):
+        """Queues pre-encoded ring frames to a client, framed by short notices."""
+        if not frames:
+            return
+        self.send_to(client_socket, f"{COLORS['blue']}--- Recent messages in #{room.name} ---{COLORS['reset']}")
+        for frame in frames:
+            self.send_raw(client_socket, frame)
+        self.send_to(client_socket, f"{COLORS['blue']}--- You are up to date ---{COLORS['reset']}")
+
+    def replay_since(self, client_socket, seq):
+        """Sends everything in the client's room after sequence number `seq`."""
+        room = self.rooms.room_of(client_socket)
+        if room is None:
+            return
+        oldest = room.recent.oldest_seq()
+        frames = room.recent.since(seq)
+        if oldest is not None and seq + 1 < oldest and self.log is not None:
+            # The ring no longer covers the gap: fill it from the durable log, newest first,
+            # so what is left out is the oldest part and the replay stays contiguous
+            older, matches = self.log.tail(MAX_HISTORY, start=seq + 1, end=oldest, counted=True,
+                                           match=lambda r: r[2] == LOG_KIND_BROADCAST and r[3] == room.name)
+            if matches > len(older):
+                self.send_to(client_socket, f"{COLORS['yellow']}[*] {matches - len(older)} earlier messages omitted.{COLORS['reset']}")
+            frames = [encode_chat_frame(r[0], r[4].encode('utf-8')) for r in older] + frames
+        elif oldest is not None and seq + 1 < oldest:
+            self.send_to(client_socket, f"{COLORS['yellow']}[*] Messages before #{oldest} are no longer buffered.{COLORS['reset']}")
+        if not frames:
+            self.send_to(client_socket, f"{COLORS['yellow']}[*] You are up to date in #{room.name}.{COLORS['reset']}")
+            return
+        self.send_catch_up(client_socket, room, frames)
+
+    def handle_message(self, client_socket, msg):
+        """Processes one message from a registered client. Returns False to end the session."""
+        sender = self.templates.get(client_socket)
+        if sender is None:
+            return False # Removed concurrently (e.g. disconnected as a slow consumer)
+
+        if self.metrics is not None and msg.startswith("/"):
+            command = msg[1:].split(None, 1)[0] if len(msg) > 1 else ''
+            self.metrics.inc('vchat_commands_total', label=f'command="{command if command in STATS_COMMANDS else "unknown"}"')
+
+        # Command processing
+        if msg.strip() == "/exit":
+            self.remove_client(client_socket, graceful=True)
+            return False
             
-            # 2. Check for duplicate usernames
-            if client_username in self.usernames:
-                client_socket.send(f"{COLORS['red']}[!] Username '{client_username}' already taken. Disconnecting.{COLORS['reset']}".encode('utf-8'))
-                client_socket.close()
-                return
-                
-            # 3. Register client
-            self.clients[client_socket] = (client_username, client_user_color, client_arrow_color)
-            self.usernames[client_username] = client_socket
+        if msg.strip() == "/users":
+            self.handle_users_command(client_socket)
+            return True
             
-            # 4. Broadcast join message
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            join_msg = f"{COLORS['yellow']}[{timestamp}] {client_username} has joined the chat!{COLORS['reset']}"
-            self.broadcast(join_msg, exclude_socket=client_socket)
+        if msg.startswith("/msg "):
+            parts = msg.split(maxsplit=2)
+            if len(parts) >= 3:
+                _, recipient, private_msg = parts
+                self.send_private(client_socket, recipient, private_msg)
+            else:
+                error_msg = f"{COLORS['red']}[!] Usage: /msg username message{COLORS['reset']}"
+                self.send_to(client_socket, error_msg)
+            return True
             
-            # 5. Send welcome message
-            welcome_msg = f"{COLORS['green']}[*] Welcome to V-Chat, {client_username}! Type /help for commands.{COLORS['reset']}"
-            client_socket.send(welcome_msg.encode('utf-8'))
+        if msg.startswith("/help"):
+            # Send help message back to client
+            self.send_help(client_socket)
+            return True
+
+        if msg.strip() == "/rooms":
+            self.handle_rooms_command(client_socket)
+            return True
+
+        if msg.strip() == "/stats":
+            self.handle_stats_command(client_socket)
+            return True
+
+        if msg.strip() == "/join" or msg.startswith("/join "):
+            parts = msg.split()
+            if len(parts) == 2:
+                self.switch_room(client_socket, parts[1].lstrip('#'))
+            else:
+                self.send_to(client_socket, f"{COLORS['red']}[!] Usage: /join room{COLORS['reset']}")
+            return True
+
+        if msg.strip() == "/part":
+            self.switch_room(client_socket, DEFAULT_ROOM)
+            return True
+
+        if msg.startswith("/since "):
+            parts = msg.split()
+            if len(parts) == 2 and SEQ_PATTERN.match(parts[1]):
+                self.replay_since(client_socket, int(parts[1]))
+            else:
+                self.send_to(client_socket, f"{COLORS['red']}[!] Usage: /since sequence_number{COLORS['reset']}")
+            return True
+
+        if msg.strip() == "/history" or msg.startswith("/history "):
+            self.handle_history_command(client_socket, msg[len("/history"):].strip())
+            return True
             
-            # 6. Message handling loop
+        # Broadcast regular message to the sender's room, within the room's flood limits
+        room = self.rooms.room_of(client_socket)
+        if room is not None and room.limiter:
+            now = time.monotonic()
+            if not room.limiter.admit(len(msg), now):
+                if self.metrics is not None:
+                    self.metrics.inc('vchat_throttled_total', label='scope="room"')
+                if room.limiter.should_notify(now):
+                    self.console.write(f"{COLORS['yellow']}[!] #{room.name} is over its rate limit; dropping messages.{COLORS['reset']}", 'warning', room=room.name)
+                self.send_to(client_socket, f"{COLORS['red']}[!] #{room.name} is too busy right now; message not sent.{COLORS['reset']}")
+                return True
+        # Format: [HH:MM:SS Username] » Message, assembled from the sender's template
+        self.broadcast(msg, exclude_socket=client_socket, room=room, sender=sender)
+        return True
+
+    def switch_room(self, client_socket, name):
+        """Moves a client to another room and notifies both rooms."""
+        if not ROOM_NAME_PATTERN.match(name):
+            self.send_to(client_socket, f"{COLORS['red']}[!] Room names are 1-32 letters, digits, '-' or '_'.{COLORS['reset']}")
+            return
+        entry = self.registry.get(client_socket)
+        if entry is None:
+            return
+        username = entry[0]
+        with self.seq_lock:
+            # As in register_client: the ring snapshot and live broadcasts never overlap
+            old, room = self.rooms.join(client_socket, name)
+            if old is not room:
+                self.send_to(client_socket, f"{COLORS['green']}[*] Now chatting in #{room.name} ({len(room.members)} here).{COLORS['reset']}")
+                self.send_catch_up(client_socket, room, room.recent.since(0))
+        if client_socket not in self.registry:
+            # Disconnected while switching: do not leave a ghost member behind
+            self.rooms.leave(client_socket)
+            return
+        if old is room:
+            self.send_to(client_socket, f"{COLORS['yellow']}[*] You are already in #{name}.{COLORS['reset']}")
+            return
+        if self.relay is not None:
+            self.relay.publish(RELAY_ROOM, username, room.name)
+
+        timestamp, _ = self.clock.now()
+        if old is not None:
+            self.broadcast(f"{COLORS['yellow']}[{timestamp}] {username} left #{old.name}.{COLORS['reset']}",
+                           exclude_socket=client_socket, room=old)
+        self.broadcast(f"{COLORS['yellow']}[{timestamp}] {username} joined #{room.name}.{COLORS['reset']}",
+                       exclude_socket=client_socket, room=room)
+
+    def handle_history_command(self, client_socket, arg):
+        """Replays recent room messages and the client's PMs from the persistent log."""
+        if self.log is None:
+            self.send_to(client_socket, f"{COLORS['red']}[!] Message history is disabled on this server.{COLORS['reset']}")
+            return
+        match = HISTORY_ARG_PATTERN.match(arg)
+        if not match:
+            self.send_to(client_socket, f"{COLORS['red']}[!] Usage: /history [count] or /history 30s|15m|2h{COLORS['reset']}")
+            return
+        entry = self.registry.get(client_socket)
+        if entry is None:
+            return
+        username = entry[0]
+        room = self.rooms.room_of(client_socket)
+        room_name = room.name if room else DEFAULT_ROOM
+
+        def visible(record):
+            _, _, kind, scope, _ = record
+            if kind == LOG_KIND_BROADCAST:
+                return scope == room_name
+            return username in scope.split('|')
+
+        amount, unit = match.groups()
+        if amount is not None:
+            # Clamp before converting: a long digit string would overflow the time arithmetic
+            digits = amount.lstrip('0') or '0'
+            amount = int(digits) if len(digits) <= 10 else 10 ** 10
+        if unit:
+            # Time window: the newest messages from the first record in range (found through the time index)
+            since = max(time.time() - amount * HISTORY_UNITS[unit], 0)
+            records = self.log.tail(MAX_HISTORY, match=visible, start=self.log.seek_time(since))
+        else:
+            records = self.log.tail(min(amount or DEFAULT_HISTORY, MAX_HISTORY), match=visible)
+
+        if not records:
+            self.send_to(client_socket, f"{COLORS['yellow']}[*] No history for #{room_name} yet.{COLORS['reset']}")
+            return
+        self.send_to(client_socket, f"{COLORS['blue']}--- History for #{room_name} ({len(records)} messages) ---{COLORS['reset']}")
+        for record in records:
+            self.send_to(client_socket, record[4])
+        self.send_to(client_socket, f"{COLORS['blue']}--- End of history ---{COLORS['reset']}")
+
+    def handle_rooms_command(self, client_socket):
+        """Sends the room list with member counts, message rates and traffic totals."""
+        current = self.rooms.room_of(client_socket)
+        listing = self.rooms.listing()
+        if self.remote_users:
+            # Add members on other shards; rates and totals are this shard's own traffic
+            counts = {}
+            for _, _, room in list(self.remote_users.values()):
+                counts[room] = counts.get(room, 0) + 1
+            listing = [(name, count + counts.pop(name, 0), *traffic) for name, count, *traffic in listing]
+            listing += [(name, count, 0.0, 0, 0) for name, count in counts.items()]
+        listing = sorted(listing)
+        rooms_list = f"{COLORS['blue']}Rooms ({len(listing)}):{COLORS['reset']}\n"
+        rooms_list += "\n".join([
+            f"  {'*' if current is not None and name == current.name else ' '} #{name} - {count} users, {rate:.2f} msg/s, "
+            f"{messages} messages ({size / 1024:.1f} KB)"
+            for name, count, rate, messages, size in listing
+        ])
+        self.send_to(client_socket, rooms_list)
+
+    def handle_frames(self, client_socket, frames, registered):
+        """Dispatches decoded frames. Returns (registered, keep_open)."""
+        metrics = self.metrics
+        for frame_type, payload in frames:
+            if metrics is not None:
+                metrics.inc('vchat_frames_in_total', label=FRAME_LABELS.get(frame_type, 'type="other"'))
+                metrics.inc('vchat_bytes_in_total', len(payload))
+            data = payload.decode('utf-8', errors='replace')
+            if not registered:
+                if not self.register_client(client_socket, frame_type, data):
+                    return False, False
+                registered = True
+            elif frame_type == FRAME_TEXT:
+                limiter = self.limiters.get(client_socket)
+                if limiter is not None and not self.admit(client_socket, limiter, len(payload)):
+                    continue
+                if not self.handle_message(client_socket, data):
+                    return registered, False
+            elif frame_type == FRAME_PING:
+                self.send_raw(client_socket, encode_frame(FRAME_PONG, payload))
+            elif frame_type == FRAME_TOO_LARGE:
+                # The decoder already discarded the payload without buffering it
+                if self.metrics is not None:
+                    self.metrics.inc('vchat_oversized_total')
+                self.send_to(client_socket, f"{COLORS['red']}[!] Message of {data} bytes rejected; the limit is {self.max_message_size} bytes.{COLORS['reset']}")
+            # Unknown frame types are ignored for forward compatibility
+        return registered, True
+
+    def admit(self, client_socket, limiter, size):
+        """Applies a client's token buckets to one message. Returns False if it is dropped."""
+        now = time.monotonic()
+        if limiter.admit(size, now):
+            return True
+        if self.metrics is not None:
+            self.metrics.inc('vchat_throttled_total', label='scope="user"')
+        if limiter.should_notify(now):
+            username = (self.registry.get(client_socket) or ('?',))[0]
+            self.console.write(f"{COLORS['yellow']}[!] Throttling {username} ({limiter.throttled} messages dropped).{COLORS['reset']}", 'warning', user=username)
+            self.send_to(client_socket, f"{COLORS['red']}[!] Slow down! You are sending messages too fast; some were dropped.{COLORS['reset']}")
+        return False
+
+    def handle_client(self, client_socket, addr):
+        """Manages the connection and message flow for a single client."""
+        if self.tls is not None:
+            # The handshake runs in this thread during the first recv() calls
+            client_socket = TlsChannel.server(self.tls, client_socket)
+        decoder = FrameDecoder(self.max_message_size)
+        registered = False
+        writer = ClientWriter(self, client_socket, self.new_send_queue())
+        self.writers[client_socket] = writer
+        writer.start()
+        self.watch(client_socket)
+        try:
+            # Message handling loop: one recv may carry many frames, or part of one
             while True:
                 try:
-                    msg = client_socket.recv(1024).decode('utf-8')
-                    if not msg:
-                        break # Client disconnected
-                        
-                    # Command processing
-                    if msg.strip() == "/exit":
-                        self.remove_client(client_socket, graceful=True)
-                        break
-                        
-                    if msg.strip() == "/users":
-                        self.handle_users_command(client_socket)
-                        continue
-                        
-                    if msg.startswith("/msg "):
-                        parts = msg.split(maxsplit=2)
-                        if len(parts) >= 3:
-                            _, recipient, private_msg = parts
-                            self.send_private(client_socket, recipient, private_msg)
-                        else:
-                            error_msg = f"{COLORS['red']}[!] Usage: /msg username message{COLORS['reset']}"
-                            client_socket.send(error_msg.encode('utf-8'))
-                        continue
-                        
-                    if msg.startswith("/help"):
-                        # Send help message back to client
-                        self.send_help(client_socket)
-                        continue
-                        
-                    # Broadcast regular message
-                    timestamp = datetime.now().strftime("%H:%M:%S")
-                    # Format: [HH:MM:SS Username] » Message
-                    formatted_msg = (
-                        f"{COLORS[client_user_color]}[{timestamp} {client_username}]{COLORS['reset']} "
-                        f"{COLORS[client_arrow_color]}»{COLORS['reset']} {msg}"
-                    )
-                    self.broadcast(formatted_msg, exclude_socket=client_socket)
-                    
-                except Exception:
+                    data = client_socket.recv(65536)
+                except OSError:
                     break # Break on socket error
+                if not data:
+                    break # Client disconnected
+                if self.heartbeat is not None:
+                    self.heartbeat.touch(client_socket)
+                registered, keep_open = self.handle_frames(client_socket, decoder.feed(data), registered)
+                if not keep_open:
+                    break
 
         except Exception as e:
-            print(f"{COLORS['red']}[!] Client handler error ({addr[0]}): {e}{COLORS['reset']}")
+            self.console.write(f"{COLORS['red']}[!] Client handler error ({addr[0]}): {e}{COLORS['reset']}", 'error')
         finally:
             self.remove_client(client_socket)
 
+    def watch(self, client_socket):
+        """Enables TCP keepalive on a new connection and starts its heartbeat timer."""
+        if self.keepalive:
+            set_keepalive(client_socket, self.keepalive)
+        if self.heartbeat is not None:
+            self.heartbeat.track(client_socket)
+
+    def run_timers(self):
+        """Runs heartbeat checks and parked-session expiry; called once per tick."""
+        if self.heartbeat is not None:
+            self.check_heartbeats()
+        if self.resume_grace:
+            self.expire_sessions()
+
+    def check_heartbeats(self):
+        """Pings silent clients and drops the ones past their handshake or idle timeout."""
+        for client_socket, action in self.heartbeat.expire(time.monotonic(), self.registry.__contains__):
+            if action == 'ping':
+                if self.metrics is not None:
+                    self.metrics.inc('vchat_pings_total')
+                self.send_raw(client_socket, PING_FRAME)
+                continue
+            if self.metrics is not None:
+                self.metrics.inc('vchat_timeouts_total')
+            username = (self.registry.get(client_socket) or ('unregistered client',))[0]
+            self.console.write(f"{COLORS['yellow']}[!] Dropping {username}: {action}.{COLORS['reset']}", 'timeout', reason=action)
+            self.expire_client(client_socket)
+
+    def expire_client(self, client_socket):
+        """Wakes the client's reader thread with EOF so it cleans up as for a disconnect."""
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def timer_loop(self):
+        """Thread engine: one thread advances the timer wheels for every connection."""
+        while True:
+            time.sleep(HEARTBEAT_TICK)
+            try:
+                self.run_timers()
+            except Exception as e:
+                self.console.write(f"{COLORS['red']}[!] Timer error: {e}{COLORS['reset']}", 'error')
+
     def handle_users_command(self, client_socket):
         """Sends the list of online users to the requesting client."""
-        users_list = f"{COLORS['blue']}Online users ({len(self.usernames)-1}):{COLORS['reset']}\n"
-        
         # Filter out the server's own dummy socket for count and display
-        online_users = [
-            (username, color) for sock, (username, color, _) in self.clients.items()
-            if sock != self.server_socket
-        ]
+        templates = self.templates
+        online_users = []
+        for sock, (username, color, _) in self.registry.snapshot():
+            if sock == self.server_socket:
+                continue
+            template = templates.get(sock)
+            room = self.rooms.room_of(sock)
+            online_users.append((template.colored_name if template is not None else f"{COLORS[color]}{username}{COLORS['reset']}",
+                                 room.name if room else DEFAULT_ROOM))
+        # Users on other shard workers, as announced through the relay
+        online_users += [(f"{COLORS[color]}{user}{COLORS['reset']}", room) for user, (color, _, room) in list(self.remote_users.items())]
+        users_list = f"{COLORS['blue']}Online users ({len(online_users)}):{COLORS['reset']}\n"
 
-        users_list += "\n".join([f"  {COLORS[color]}{user}{COLORS['reset']}" 
-                               for user, color in online_users])
+        users_list += "\n".join([f"  {name} #{room}" for name, room in online_users])
         
         # Send the list
-        client_socket.send(users_list.encode('utf-8'))
+        self.send_to(client_socket, users_list)
+
+    def is_admin(self, client_socket):
+        """Returns True if the client may use admin commands."""
+        entry = self.registry.get(client_socket)
+        if entry is None:
+            return False
+        if self.admins:
+            return entry[0] in self.admins
+        # Without --admins, only clients on this machine count as admins
+        try:
+            return client_socket.getpeername()[0] in ('127.0.0.1', '::1')
+        except OSError:
+            return False
+
+    def send_queues(self):
+        """Returns the outbound queues of every connected client."""
+        return [writer.queue for writer in list(self.writers.values())]
+
+    def metric_gauges(self):
+        """Computes gauge samples from live state: [(name, label, value)]."""
+        queues = self.send_queues()
+        frames = [len(queue) for queue in queues] or [0]
+        sizes = [queue.queued_bytes for queue in queues] or [0]
+        return [
+            ('vchat_clients', '', len(self.registry) - 1),  # Minus the server's own entry
+            ('vchat_rooms', '', len(self.rooms.rooms)),
+            ('vchat_send_queue_frames', 'stat="sum"', sum(frames)),
+            ('vchat_send_queue_frames', 'stat="max"', max(frames)),
+            ('vchat_send_queue_bytes', 'stat="sum"', sum(sizes)),
+            ('vchat_send_queue_bytes', 'stat="max"', max(sizes)),
+            ('vchat_send_queue_dropped', '', sum(queue.dropped for queue in queues)),
+        ]
+
+    def handle_stats_command(self, client_socket):
+        """Sends a summary of the server's metrics to an admin."""
+        if not self.is_admin(client_socket):
+            self.send_to(client_socket, f"{COLORS['red']}[!] /stats is only available to server admins.{COLORS['reset']}")
+            return
+        metrics = self.metrics
+        if metrics is None:
+            self.send_to(client_socket, f"{COLORS['red']}[!] Metrics are disabled on this server (start it with --metrics).{COLORS['reset']}")
+            return
+        gauges = {(name, label): value for name, label, value in metrics.gauges()}
+        queued = gauges[('vchat_send_queue_frames', 'stat="sum"')]
+        deepest = gauges[('vchat_send_queue_frames', 'stat="max"')]
+        uptime = time.time() - metrics.started
+        with metrics.lock:
+            fanout = metrics.histograms['vchat_broadcast_fanout_seconds']
+            p50, p99, fanouts = fanout.quantile(0.5), fanout.quantile(0.99), fanout.count
+            commands = sorted((label.split('"')[1], value) for (name, label), value in metrics.counters.items()
+                              if name == 'vchat_commands_total')
+
+        def bound(seconds):
+            return f"<={seconds * 1000:g} ms" if seconds is not None else "n/a"
+
+        lines = [
+            f"{COLORS['blue']}Server stats (up {int(uptime // 3600)}h{int(uptime % 3600 // 60):02d}m):{COLORS['reset']}",
+            f"  clients {gauges[('vchat_clients', '')]}, rooms {gauges[('vchat_rooms', '')]}, "
+            f"connections {metrics.counter('vchat_connections_total')}, disconnects {metrics.counter('vchat_disconnects_total')}",
+            f"  in  {metrics.counter('vchat_frames_in_total')} frames, {metrics.counter('vchat_bytes_in_total')} bytes",
+            f"  out {metrics.counter('vchat_frames_out_total')} frames, {metrics.counter('vchat_bytes_out_total')} bytes",
+            f"  broadcasts {metrics.counter('vchat_broadcasts_total')} (fan-out p50 {bound(p50)}, p99 {bound(p99)}, {fanouts} timed), "
+            f"PMs {metrics.counter('vchat_private_messages_total')}",
+            f"  send queues {queued} frames queued (max {deepest}), {gauges[('vchat_send_queue_dropped', '')]} dropped",
+            f"  send errors {metrics.counter('vchat_send_errors_total')}, slow-consumer disconnects "
+            f"{metrics.counter('vchat_slow_consumer_disconnects_total')}, throttled {metrics.counter('vchat_throttled_total')}, "
+            f"oversized {metrics.counter('vchat_oversized_total')}",
+            "  commands " + (", ".join(f"/{name} {count}" for name, count in commands) or "none"),
+        ]
+        self.send_to(client_socket, "\n".join(lines))
 
     def send_help(self, client_socket):
         """Sends the available commands list to the requesting client."""
@@ -351,53 +2752,981 @@ class ChatServer:
         help_msg += f"{COLORS['yellow']}/exit{COLORS['reset']} - Disconnect from chat\n"
         help_msg += f"{COLORS['yellow']}/msg username message{COLORS['reset']} - Send private message\n"
         help_msg += f"{COLORS['yellow']}/users{COLORS['reset']} - List online users\n"
+        help_msg += f"{COLORS['yellow']}/join room{COLORS['reset']} - Switch to (or create) a room\n"
+        help_msg += f"{COLORS['yellow']}/part{COLORS['reset']} - Go back to #{DEFAULT_ROOM}\n"
+        help_msg += f"{COLORS['yellow']}/rooms{COLORS['reset']} - List rooms with member counts\n"
+        help_msg += f"{COLORS['yellow']}/history [N|15m]{COLORS['reset']} - Replay recent messages\n"
+        help_msg += f"{COLORS['yellow']}/since N{COLORS['reset']} - Replay everything after message number N\n"
+        help_msg += f"{COLORS['yellow']}/stats{COLORS['reset']} - Server statistics (admins only)\n"
         help_msg += f"{COLORS['yellow']}@username{COLORS['reset']} - Mention someone (plays sound)\n"
         
-        client_socket.send(help_msg.encode('utf-8'))
+        self.send_to(client_socket, help_msg)
 
 
     def run(self):
         """Main server loop, accepting connections."""
+        if self.relay is not None:
+            threading.Thread(target=self.relay.reader_loop, daemon=True).start()
+        if self.timers_enabled:
+            threading.Thread(target=self.timer_loop, daemon=True).start()
         try:
-            while True:
+            while self.running:
                 client, addr = self.server.accept()
-                print(f"{COLORS['green']}[+] New connection from {addr[0]}:{addr[1]}{COLORS['reset']}")
+                if not self.running:
+                    client.close()
+                    break
+                self.console.write(f"{COLORS['green']}[+] New connection from {addr[0]}:{addr[1]}{COLORS['reset']}", 'connect', address=f"{addr[0]}:{addr[1]}")
+                if self.metrics is not None:
+                    self.metrics.inc('vchat_connections_total')
+                set_nodelay(client)
                 # Start a new thread to handle each client connection
                 threading.Thread(target=self.handle_client, args=(client, addr)).start()
         except KeyboardInterrupt:
-            print(f"\n{COLORS['red']}[!] Server shutting down.{COLORS['reset']}")
+            self.console.write(f"\n{COLORS['red']}[!] Server shutting down.{COLORS['reset']}")
         except Exception as e:
-            print(f"{COLORS['red']}[!] Server error: {e}{COLORS['reset']}")
+            self.console.write(f"{COLORS['red']}[!] Server error: {e}{COLORS['reset']}", 'error')
         finally:
             # Cleanup all active client connections
-            for client in list(self.clients.keys()):
-                self.remove_client(client)
+            for client, _ in self.registry.snapshot():
+                self.remove_client(client, resumable=False)
+            if self.log is not None:
+                self.log.close()
             self.server.close()
+            self.console.close()
+
+def raise_fd_limit():
+    """Raises the soft open-file limit to the hard limit so one process can hold 10k+ sockets."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+    except (ImportError, ValueError, OSError):
+        # Not available on Windows, or not permitted: keep the current limit
+        pass
+
+class Connection:
+    """Per-socket state for the event-loop server engine."""
+    __slots__ = ('sock', 'addr', 'decoder', 'outbox', 'writing', 'registered', 'closing', 'closed')
+
+    def __init__(self, sock, addr, outbox, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.addr = addr
+        self.decoder = FrameDecoder(max_frame_size)
+        self.outbox = outbox       # OutboundQueue of frames not yet accepted by the kernel
+        self.writing = False       # True while EVENT_WRITE interest is registered
+        self.registered = False    # True once the handshake succeeded
+        self.closing = False       # Close as soon as the outbound buffer drains
+        self.closed = False
+
+class EventLoopChatServer(ChatServer):
+    """Single-threaded ChatServer engine built on a non-blocking selectors loop.
+
+    Keeps the handshake, commands and clients/usernames registry of ChatServer,
+    but multiplexes every socket in one thread instead of one thread per client.
+    """
+    def __init__(self, host, port, username, user_color, arrow_color, **options):
+        raise_fd_limit()
+        options.setdefault('backlog', socket.SOMAXCONN)
+        super().__init__(host, port, username, user_color, arrow_color, **options)
+        self.server.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ, None)
+        self.connections = {}  # {socket: Connection}
+        self.dirty = set()  # Connections with newly queued frames, flushed once per loop pass
+
+    def send_raw(self, client_socket, data, droppable=False):
+        """Queues frames for a client; they are written in one batch at the end of the loop pass."""
+        conn = self.connections.get(client_socket)
+        if conn is None or conn.closed:
+            return
+        if self.metrics is not None:
+            self.metrics.inc('vchat_frames_out_total')
+            self.metrics.inc('vchat_bytes_out_total', len(data))
+        if not conn.outbox.push(data, droppable):
+            if self.metrics is not None:
+                self.metrics.inc('vchat_slow_consumer_disconnects_total')
+            self.console.write(f"{COLORS['red']}[!] Disconnecting slow client ({conn.addr[0]}:{conn.addr[1]}).{COLORS['reset']}", 'warning')
+            conn.outbox.clear()
+            self._drop(conn)
+            return
+        if not conn.writing:
+            self.dirty.add(conn)
+
+    def expire_client(self, client_socket):
+        """Drops a timed-out connection directly; there is no reader thread to wake."""
+        conn = self.connections.get(client_socket)
+        if conn is not None:
+            self._drop(conn)
+
+    def send_queues(self):
+        """Returns the outbound buffers of every open connection."""
+        return [conn.outbox for conn in list(self.connections.values())]
+
+    def enable_compression(self, client_socket):
+        """Switches a connection's outbox to deflate; it is compressed when next flushed."""
+        conn = self.connections.get(client_socket)
+        if conn is None or conn.closed:
+            return
+        conn.outbox.start_compression(self.compression_level)
+        if not conn.writing:
+            self.dirty.add(conn)
+        if self.metrics is not None:
+            self.metrics.inc('vchat_compressed_connections_total')
+
+    def close_client_socket(self, client_socket):
+        """Unregisters the socket from the selector before closing it."""
+        conn = self.connections.pop(client_socket, None)
+        if conn is not None:
+            conn.closed = True
+        try:
+            self.selector.unregister(client_socket)
+        except (KeyError, ValueError):
+            pass
+        super().close_client_socket(client_socket)
+
+    def _drop(self, conn):
+        """Tears down a connection, announcing the departure if it was registered."""
+        if conn.closed:
+            return
+        if conn.sock in self.registry:
+            self.remove_client(conn.sock)
+        else:
+            self.close_client_socket(conn.sock)
+
+    def _flush(self, conn):
+        """Writes pending bytes without blocking and toggles write interest as needed."""
+        try:
+            if self.tls is not None:
+                conn.sock.flush() # Encrypted bytes left over from an earlier pass
+            conn.outbox.write_to(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            if self.metrics is not None:
+                self.metrics.inc('vchat_send_errors_total')
+            conn.outbox.clear()
+            self._drop(conn)
+            return
+
+        backlog = self.tls is not None and bool(conn.sock.backlog)
+        if not conn.outbox and not backlog and conn.closing:
+            self._drop(conn)
+            return
+
+        want_write = bool(conn.outbox) or backlog
+        if want_write != conn.writing:
+            conn.writing = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.selector.modify(conn.sock, events, conn)
+
+    def _flush_dirty(self):
+        """Writes every connection that queued frames during this loop pass."""
+        while self.dirty:
+            conn = self.dirty.pop()
+            if not conn.closed and not conn.writing:
+                self._flush(conn)
+
+    def _accept(self):
+        """Accepts every pending connection on the listening socket."""
+        while True:
+            try:
+                client, addr = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. EMFILE: leave the rest in the backlog until descriptors free up
+                self.console.write(f"{COLORS['red']}[!] Accept error: {e}{COLORS['reset']}", 'error')
+                return
+            self.console.write(f"{COLORS['green']}[+] New connection from {addr[0]}:{addr[1]}{COLORS['reset']}", 'connect', address=f"{addr[0]}:{addr[1]}")
+            if self.metrics is not None:
+                self.metrics.inc('vchat_connections_total')
+            client.setblocking(False)
+            set_nodelay(client)
+            if self.tls is not None:
+                # Non-blocking: the handshake advances in _read() like any other input
+                client = TlsChannel.server(self.tls, client)
+            conn = Connection(client, addr, self.new_send_queue(), self.max_message_size)
+            self.connections[client] = conn
+            self.selector.register(client, selectors.EVENT_READ, conn)
+            self.watch(client)
+
+    def _read(self, conn):
+        """Reads from a ready socket and dispatches every complete frame it carried."""
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            if self.tls is not None and conn.sock.backlog and not conn.writing:
+                self.dirty.add(conn) # Handshake records the socket did not take yet
+            return
+        except OSError:
+            self._drop(conn)
+            return
+        if not data:
+            self._drop(conn)
+            return
+        if conn.closing:
+            return
+        if self.heartbeat is not None:
+            self.heartbeat.touch(conn.sock)
+
+        try:
+            was_registered = conn.registered
+            conn.registered, keep_open = self.handle_frames(conn.sock, conn.decoder.feed(data), was_registered)
+            if keep_open:
+                return
+            if not conn.registered:
+                # Rejected handshake: let the notice drain before closing
+                conn.closing = True
+                self._flush(conn)
+            else:
+                self._drop(conn)
+        except Exception as e:
+            self.console.write(f"{COLORS['red']}[!] Client handler error ({conn.addr[0]}): {e}{COLORS['reset']}", 'error')
+            self._drop(conn)
+
+    def run(self):
+        """Main event loop: accepts, reads and writes on every socket from one thread."""
+        self.console.write(f"{COLORS['blue']}[*]{COLORS['reset']} Event-loop engine ready ({type(self.selector).__name__}).")
+        if self.relay is not None:
+            self.selector.register(self.relay.sock, selectors.EVENT_READ, self.relay)
+        # With heartbeats or session resumption on, wake at least once per wheel tick to expire timers
+        timeout = HEARTBEAT_TICK if self.timers_enabled else None
+        next_check = time.monotonic() + HEARTBEAT_TICK
+        try:
+            while self.running:
+                for key, mask in self.selector.select(timeout):
+                    conn = key.data
+                    if conn is None:
+                        self._accept()
+                        if not self.running:
+                            break
+                        continue
+                    if conn is self.relay:
+                        if not self.relay.on_readable():
+                            self.selector.unregister(self.relay.sock)
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self._read(conn)
+                    if mask & selectors.EVENT_WRITE and not conn.closed:
+                        self._flush(conn)
+                if timeout is not None and time.monotonic() >= next_check:
+                    self.run_timers()
+                    next_check = time.monotonic() + HEARTBEAT_TICK
+                self._flush_dirty()
+        except KeyboardInterrupt:
+            self.console.write(f"\n{COLORS['red']}[!] Server shutting down.{COLORS['reset']}")
+        except Exception as e:
+            self.console.write(f"{COLORS['red']}[!] Server error: {e}{COLORS['reset']}", 'error')
+        finally:
+            # Cleanup all active client connections, registered or not
+            for client, _ in self.registry.snapshot():
+                self.remove_client(client, resumable=False)
+            for conn in list(self.connections.values()):
+                self.close_client_socket(conn.sock)
+            if self.log is not None:
+                self.log.close()
+            self.selector.close()
+            self.server.close()
+            self.console.close()
+
+SERVER_ENGINES = {'thread': ChatServer, 'event': EventLoopChatServer}
+
+# --- Sharding ---
+# With --workers N the server runs N worker processes that share the listening
+# port via SO_REUSEPORT. Workers publish broadcasts, PMs and user-list changes to
+# a RelayHub in the parent process over a Unix socket, using the normal frame
+# format with the relay types below; fields are separated by NUL characters.
+RELAY_HELLO = 20      # shard_id
+RELAY_JOIN = 21       # username | user_color | arrow_color | room
+RELAY_LEAVE = 22      # username
+RELAY_ROOM = 23       # username | room
+RELAY_BROADCAST = 24  # room | username | user_color | arrow_color | unrendered message (author fields empty for notices)
+RELAY_PRIVATE = 25    # recipient | sender | sender_color | message
+RELAY_REJECT = 26     # username (lost a cross-shard name race)
+RELAY_QUEUE_BYTES = 64 * 1024 * 1024  # A worker this far behind on relay traffic is disconnected by the hub
+RELAY_SEND_TIMEOUT = 2.0  # Seconds a worker waits for a busy hub before giving up on it
+
+# Frames whose last field is user text: it is split off whole, so a '\0' in it cannot forge other fields
+RELAY_FIELD_COUNTS = {RELAY_BROADCAST: 5, RELAY_PRIVATE: 4}
+
+def encode_relay(frame_type, *fields):
+    """Encodes a relay frame from text fields."""
+    return encode_frame(frame_type, '\0'.join(fields))
+
+def decode_relay(frame_type, payload):
+    """Splits a relay frame payload back into its text fields."""
+    return payload.decode('utf-8', errors='replace').split('\0', RELAY_FIELD_COUNTS.get(frame_type, 0) - 1)
+
+class RelayHub:
+    """Local pub/sub broker connecting the shard workers.
+
+    Forwards every relay frame to the other workers (PMs only to the shard that
+    owns the recipient), keeps the cluster-wide user directory so late workers can
+    catch up, and arbitrates username races between shards.
+    """
+    def __init__(self, path, console=None):
+        self.path = path
+        self.console = console
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.workers = {}    # {socket: Connection}
+        self.shards = {}     # {socket: shard_id}
+        self.directory = {}  # {username: (socket, [user_color, arrow_color, room])}
+        self.running = True
+
+    def _send(self, conn, data):
+        """Queues relay data to a worker and writes what the socket accepts."""
+        if conn.closed:
+            return
+        if not conn.outbox.push(data):
+            # Dropping frames would leave the worker's user directory out of sync: cut it
+            # loose instead, so its users are announced as gone and it runs standalone
+            if self.console is not None:
+                self.console.write(f"{COLORS['red']}[!] Relay: shard {self.shards.get(conn.sock, '?')} fell behind, disconnecting it.{COLORS['reset']}", 'warning')
+            conn.outbox.clear()
+            self._drop(conn)
+            return
+        self._flush(conn)
+
+    def _flush(self, conn):
+        try:
+            conn.outbox.write_to(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._drop(conn)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.outbox else 0)
+        self.selector.modify(conn.sock, events, conn)
+
+    def _publish(self, origin, data):
+        """Sends relay data to every worker except the origin."""
+        for sock, conn in list(self.workers.items()):
+            if sock is not origin:
+                self._send(conn, data)
+
+    def _drop(self, conn):
+        """Forgets a worker that went away, announcing its users as gone."""
+        if conn.closed:
+            return
+        conn.closed = True
+        self.workers.pop(conn.sock, None)
+        self.shards.pop(conn.sock, None)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        for username, (owner, _) in list(self.directory.items()):
+            if owner is conn.sock:
+                del self.directory[username]
+                self._publish(None, encode_relay(RELAY_LEAVE, username))
+
+    def _handle(self, conn, frame_type, payload):
+        """Routes one relay frame from a worker."""
+        sock = conn.sock
+        fields = decode_relay(frame_type, payload)
+        if frame_type == RELAY_HELLO:
+            self.shards[sock] = fields[0]
+            # Bring the new worker up to date with users on other shards
+            for username, (owner, info) in self.directory.items():
+                if owner is not sock:
+                    self._send(conn, encode_relay(RELAY_JOIN, username, *info))
+            return
+        if frame_type == RELAY_JOIN:
+            username = fields[0]
+            owner = self.directory.get(username)
+            if owner is not None and owner[0] is not sock:
+                self._send(conn, encode_relay(RELAY_REJECT, username))
+                return
+            self.directory[username] = (sock, fields[1:4])
+        elif frame_type == RELAY_LEAVE:
+            owner = self.directory.get(fields[0])
+            if owner is None or owner[0] is not sock:
+                return
+            del self.directory[fields[0]]
+        elif frame_type == RELAY_ROOM:
+            owner = self.directory.get(fields[0])
+            if owner is None or owner[0] is not sock:
+                return
+            owner[1][2] = fields[1]
+        elif frame_type == RELAY_PRIVATE:
+            owner = self.directory.get(fields[0])
+            if owner is not None and owner[0] in self.workers:
+                self._send(self.workers[owner[0]], encode_frame(frame_type, payload))
+            return
+        self._publish(sock, encode_frame(frame_type, payload))
+
+    def run(self):
+        """Runs the hub loop until stop() is called."""
+        while self.running:
+            for key, mask in self.selector.select(timeout=0.5):
+                conn = key.data
+                if conn is None:
+                    try:
+                        sock, _ = self.listener.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    sock.setblocking(False)
+                    conn = Connection(sock, ('relay', 0), OutboundQueue(1 << 20, RELAY_QUEUE_BYTES, 'disconnect'), TRUSTED_MAX_FRAME_SIZE)
+                    self.workers[sock] = conn
+                    self.selector.register(sock, selectors.EVENT_READ, conn)
+                    continue
+                if mask & selectors.EVENT_READ:
+                    try:
+                        data = conn.sock.recv(65536)
+                    except (BlockingIOError, InterruptedError):
+                        data = None
+                    except OSError:
+                        data = b''
+                    if data == b'':
+                        self._drop(conn)
+                        continue
+                    if data:
+                        for frame_type, payload in conn.decoder.feed(data):
+                            if conn.closed:
+                                break
+                            self._handle(conn, frame_type, payload)
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    self._flush(conn)
+
+    def stop(self):
+        """Stops the loop and removes the socket file."""
+        self.running = False
+
+    def close(self):
+        for conn in list(self.workers.values()):
+            self._drop(conn)
+        self.selector.close()
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+class ShardRelay:
+    """Worker-side link to the RelayHub: publishes local events, applies remote ones."""
+    def __init__(self, server, path, shard_id):
+        self.server = server
+        self.shard_id = shard_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        # Bounds publish() on a busy hub; the thread engine's reader treats a timeout as idle
+        self.sock.settimeout(RELAY_SEND_TIMEOUT)
+        self.decoder = FrameDecoder(TRUSTED_MAX_FRAME_SIZE)
+        self.lock = threading.Lock()
+        self.alive = True
+        self.publish(RELAY_HELLO, str(shard_id))
+
+    def publish(self, frame_type, *fields):
+        """Sends a relay frame to the hub, giving up on it after RELAY_SEND_TIMEOUT."""
+        if not self.alive:
+            return
+        try:
+            with self.lock:
+                self.sock.sendall(encode_relay(frame_type, *fields))
+        except OSError:
+            self.lost()
+
+    def on_readable(self):
+        """Reads from the hub and applies every complete relay frame."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return self.alive
+        except OSError:
+            data = b''
+        if not data:
+            self.lost()
+            return False
+        for frame_type, payload in self.decoder.feed(data):
+            self.server.apply_relay(frame_type, decode_relay(frame_type, payload))
+        return True
+
+    def reader_loop(self):
+        """Blocking reader used by the thread engine."""
+        while self.alive and self.on_readable():
+            pass
+
+    def lost(self):
+        """Falls back to standalone operation when the hub goes away."""
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            # A timed-out send may have left half a frame: end the stream (the reader sees EOF)
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.console.write(f"{COLORS['red']}[!] Shard {self.shard_id}: lost relay hub, continuing standalone.{COLORS['reset']}", 'warning')
+        self.server.forget_remote_users()
+
+def run_shard(shard_id, relay_path, engine, host, port, username, user_color, arrow_color, options):
+    """Worker process entry point: one server instance sharing the port with its peers."""
+    options = dict(options)
+    if options.get('log_dir'):
+        # Each worker owns its own log; segments must never be shared between writers
+        options['log_dir'] = os.path.join(options['log_dir'], f"shard-{shard_id}")
+    if options.get('metrics_port'):
+        # One endpoint per worker: scrape metrics_port, metrics_port + 1, ...
+        options['metrics_port'] += shard_id
+    banner = options.pop('banner', True) and shard_id == 0
+    server = SERVER_ENGINES[engine](host, port, username, user_color, arrow_color,
+                                    reuse_port=True, relay_path=relay_path, shard_id=shard_id,
+                                    banner=banner, **options)
+    server.run()
+
+def run_sharded(workers, engine, host, port, username, user_color, arrow_color, options):
+    """Starts the relay hub and `workers` server processes on the same port."""
+    import multiprocessing
+    import signal
+    import tempfile
+    # The hub's own lines follow the workers' console settings (plain text when headless)
+    console = ServerConsole(ansi=not options.get('headless'))
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        console.write(f"{COLORS['red']}[!] --workers needs SO_REUSEPORT and Unix sockets (Linux/BSD).{COLORS['reset']}", 'error')
+        console.close()
+        sys.exit(1)
+
+    relay_dir = tempfile.mkdtemp(prefix='vchat-relay-')
+    relay_path = os.path.join(relay_dir, 'relay.sock')
+    hub = RelayHub(relay_path, console)
+    processes = [
+        multiprocessing.Process(target=run_shard, daemon=True,
+                                args=(i, relay_path, engine, host, port, username, user_color, arrow_color, options))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # A plain kill (SIGTERM) must also stop the workers and remove the socket directory
+    signal.signal(signal.SIGTERM, lambda signum, frame: hub.stop())
+    console.write(f"{COLORS['blue']}[*]{COLORS['reset']} Relay hub up with {workers} worker processes on port {port}.")
+    try:
+        hub.run()
+    except KeyboardInterrupt:
+        console.write(f"\n{COLORS['red']}[!] Stopping workers.{COLORS['reset']}")
+    finally:
+        # Workers first, so they do not report the hub going away
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(5)
+        hub.close()
+        os.rmdir(relay_dir)
+        console.close()
+
+# --- Benchmark ---
+BENCH_MIX = (('broadcast', 0.80), ('pm', 0.15), ('users', 0.05))  # Share of each operation in the load
+BENCH_TOKEN = re.compile(rb'bench:(\d+):')  # Send timestamp (perf_counter_ns) embedded in each message
+
+def process_usage():
+    """Returns (cpu_seconds, rss_bytes) for this process; rss is 0 where it cannot be read."""
+    times = os.times()
+    rss = 0
+    try:
+        with open('/proc/self/statm') as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        try:
+            import resource
+            # Peak rather than current RSS: the best that getrusage offers
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            rss = peak if sys.platform == 'darwin' else peak * 1024
+        except ImportError:
+            pass
+    return times.user + times.system, rss
+
+def latency_summary(samples_ns):
+    """Returns count, mean and p50/p99/p999/max of latency samples, in milliseconds."""
+    if not samples_ns:
+        return {'count': 0}
+    samples = sorted(samples_ns)
+    count = len(samples)
+
+    def rank(q):
+        # Nearest-rank percentile
+        return round(samples[min(count - 1, max(0, math.ceil(q * count) - 1))] / 1e6, 3)
+
+    return {'count': count, 'mean': round(sum(samples) / count / 1e6, 3),
+            'p50': rank(0.50), 'p99': rank(0.99), 'p999': rank(0.999), 'max': round(samples[-1] / 1e6, 3)}
+
+def run_bench_server(control, engine, options):
+    """Benchmark child process: serves on a free localhost port and answers usage queries."""
+    # Console output would dominate the measurement; the load is all that is timed
+    sys.stdout = open(os.devnull, 'w')
+    options = dict(options)
+    options.setdefault('headless', True)
+    # The same listen backlog for both engines: with the thread engine's default of 10
+    # the connect burst overflowed it, and 1 s / 2 s SYN retransmits were what got timed
+    options.setdefault('backlog', socket.SOMAXCONN)
+    server = SERVER_ENGINES[engine]('127.0.0.1', 0, 'bench-host', 'green', 'blue', banner=False, **options)
+    threading.Thread(target=server.run, daemon=True).start()
+    control.send(server.server.getsockname()[1])
+    while control.recv() == 'usage':
+        control.send(process_usage())
+
+class BenchClient:
+    """One simulated ChatClient connection driven by the benchmark's event loop."""
+    __slots__ = ('sock', 'name', 'decoder', 'stream', 'connected_at', 'welcomed', 'pending_users')
+
+    def __init__(self, name, compress=False):
+        self.name = name
+        self.decoder = FrameDecoder(TRUSTED_MAX_FRAME_SIZE)
+        self.stream = StreamInflater() if compress else None
+        self.connected_at = 0
+        self.welcomed = False
+        self.pending_users = deque()  # Send times of unanswered /users requests
+
+class ChatBenchmark:
+    """Load generator: drives simulated clients against a server in a child process.
+
+    Every client performs the real handshake; the load is a mix of room
+    broadcasts, /msg PMs and /users requests sent at a fixed total rate.
+    Each message carries its send time, so every delivery is a fan-out
+    latency sample measured end to end on one clock.
+    """
+    def __init__(self, engine='thread', clients=200, duration=10.0, rate=100.0, message_size=64,
+                 options=None, seed=1, compress=False, tls=None):
+        import random
+        self.engine = engine
+        self.client_count = clients
+        self.duration = duration
+        self.rate = rate
+        self.message_size = message_size
+        self.options = options or {}
+        self.random = random.Random(seed)
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.latency = {'connect': [], 'broadcast': [], 'pm': [], 'users': []}
+        self.sent = {'broadcast': 0, 'pm': 0, 'users': 0}
+        self.expected = 0   # Deliveries owed for everything sent so far
+        self.delivered = 0
+        self.disconnects = 0
+        self.compress = compress  # Clients negotiate the deflate stream
+        self.wire_bytes = 0       # Bytes received from the server, as sent over the socket
+        self.tls = tls            # Client TLS context when benchmarking a --tls-cert server
+
+    def run(self):
+        """Runs the benchmark and returns its results as a JSON-serializable dict."""
+        import multiprocessing
+        raise_fd_limit()
+        control, child_control = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=run_bench_server, daemon=True,
+                                         args=(child_control, self.engine, self.options))
+        server.start()
+        try:
+            port = control.recv()
+            _, idle_rss = self.server_usage(control)
+            connect_time = self.connect(port)
+            _, loaded_rss = self.server_usage(control)
+
+            server_cpu = self.server_usage(control)[0]
+            driver_cpu = process_usage()[0]
+            wire_bytes = self.wire_bytes
+            started = time.perf_counter()
+            self.load()
+            self.drain()
+            elapsed = time.perf_counter() - started
+            server_cpu = self.server_usage(control)[0] - server_cpu
+            driver_cpu = process_usage()[0] - driver_cpu
+            wire_bytes = self.wire_bytes - wire_bytes
+            _, final_rss = self.server_usage(control)
+            tls = self.tls_handshakes(port) if self.tls is not None else None
+            control.send('stop')
+        finally:
+            for client in self.clients:
+                client.sock.close()
+            self.selector.close()
+            server.join(5)
+            if server.is_alive():
+                server.terminate()
+
+        import platform
+        messages = sum(self.sent.values())
+        return {
+            'benchmark': 'v-chat',
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'engine': self.engine,
+            'clients': self.client_count,
+            'duration_s': self.duration,
+            'target_rate': self.rate,
+            'message_bytes': self.message_size,
+            'compression': 'deflate' if self.compress else None,
+            'tls': tls,
+            'mix': dict(BENCH_MIX),
+            'connect': {'seconds': round(connect_time, 3), 'per_s': round(self.client_count / connect_time, 1),
+                        'latency_ms': latency_summary(self.latency['connect']),
+                        # A dropped SYN is retried after 1 s: these measure the listen backlog, not the server
+                        'over_1s': sum(1 for sample in self.latency['connect'] if sample >= 1e9)},
+            'throughput': {
+                'elapsed_s': round(elapsed, 3),
+                'messages_sent': messages,
+                'messages_per_s': round(messages / elapsed, 1),
+                'sent': dict(self.sent),
+                'deliveries': self.delivered,
+                'deliveries_per_s': round(self.delivered / elapsed, 1),
+                'expected_deliveries': self.expected,
+                'delivery_ratio': round(self.delivered / self.expected, 4) if self.expected else 1.0,
+                'disconnects': self.disconnects,
+            },
+            'wire': {
+                'bytes_received': wire_bytes,
+                'bytes_per_s': round(wire_bytes / elapsed),
+                'bytes_per_delivery': round(wire_bytes / self.delivered, 1) if self.delivered else None,
+            },
+            'latency_ms': {op: latency_summary(self.latency[op]) for op in ('broadcast', 'pm', 'users')},
+            'memory': {
+                'server_rss_idle_bytes': idle_rss,
+                'server_rss_loaded_bytes': loaded_rss,
+                'server_rss_final_bytes': final_rss,
+                'bytes_per_connection': (loaded_rss - idle_rss) // self.client_count if idle_rss else None,
+            },
+            'cpu': {
+                'server_seconds': round(server_cpu, 3),
+                'server_percent': round(100 * server_cpu / elapsed, 1),
+                'driver_seconds': round(driver_cpu, 3),
+                'driver_percent': round(100 * driver_cpu / elapsed, 1),
+            },
+        }
+
+    def server_usage(self, control):
+        """Asks the server process for its (cpu_seconds, rss_bytes)."""
+        control.send('usage')
+        return control.recv()
+
+    def connect(self, port, timeout=60.0):
+        """Connects and registers every client. Returns the seconds it took."""
+        started = time.perf_counter()
+        for i in range(self.client_count):
+            client = BenchClient(f"bench{i}", self.compress)
+            client.connected_at = time.perf_counter_ns()
+            client.sock = socket.create_connection(('127.0.0.1', port))
+            set_nodelay(client.sock)
+            if self.tls is not None:
+                client.sock = TlsChannel.client(self.tls, client.sock, '127.0.0.1')
+                client.sock.do_handshake()
+            capabilities = "|deflate" if self.compress else ""
+            client.sock.sendall(encode_frame(FRAME_HANDSHAKE, f"{client.name}|green|blue{capabilities}"))
+            # Blocking sockets are fine: recv only runs once the selector reports data
+            self.selector.register(client.sock, selectors.EVENT_READ, client)
+            self.clients.append(client)
+            self.pump(0)
+        deadline = time.perf_counter() + timeout
+        while not all(client.welcomed for client in self.clients):
+            if time.perf_counter() > deadline:
+                raise TimeoutError("Not every benchmark client was welcomed")
+            self.pump(0.05)
+        return time.perf_counter() - started
+
+    def tls_handshakes(self, port, samples=50):
+        """Times full and resumed TLS handshakes (connect included) against the loaded server."""
+        timings = {'full': [], 'resumed': []}
+        reused = 0
+        for client in self.clients[:samples]:
+            # Benchmark clients have read their session tickets by now
+            for kind, session in (('full', None), ('resumed', client.sock.session)):
+                started = time.perf_counter_ns()
+                sock = TlsChannel.client(self.tls, socket.create_connection(('127.0.0.1', port)), '127.0.0.1', session)
+                sock.do_handshake()
+                timings[kind].append(time.perf_counter_ns() - started)
+                if kind == 'resumed' and sock.session_reused:
+                    reused += 1
+                sock.close()
+        return {'full_handshake_ms': latency_summary(timings['full']),
+                'resumed_handshake_ms': latency_summary(timings['resumed']),
+                'resumed_ratio': round(reused / len(timings['resumed']), 3) if timings['resumed'] else None}
+
+    def load(self):
+        """Sends the operation mix at the target rate for the configured duration."""
+        interval = 1.0 / self.rate
+        ops = [op for op, _ in BENCH_MIX]
+        weights = [share for _, share in BENCH_MIX]
+        padding = 'x' * max(0, self.message_size - 32)
+        end = time.perf_counter() + self.duration
+        next_send = time.perf_counter()
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            while next_send <= now:
+                self.send(self.random.choices(ops, weights)[0], padding)
+                next_send += interval
+            self.pump(max(0.0, min(next_send, end) - time.perf_counter()))
+
+    def send(self, op, padding):
+        """Performs one operation from a random client."""
+        client = self.random.choice(self.clients)
+        stamp = time.perf_counter_ns()
+        if op == 'broadcast':
+            text = f"bench:{stamp}: {padding}"
+            self.expected += len(self.clients) - 1
+        elif op == 'pm':
+            recipient = self.random.choice(self.clients)
+            while recipient is client and len(self.clients) > 1:
+                recipient = self.random.choice(self.clients)
+            text = f"/msg {recipient.name} bench:{stamp}: {padding}"
+            self.expected += 1
+        else:
+            text = "/users"
+            client.pending_users.append(stamp)
+            self.expected += 1
+        self.sent[op] += 1
+        client.sock.sendall(encode_frame(FRAME_TEXT, text))
+
+    def drain(self, idle_timeout=5.0):
+        """Keeps reading until every expected delivery arrived or the server goes quiet."""
+        last = (self.delivered, time.perf_counter())
+        while self.delivered < self.expected:
+            self.pump(0.1)
+            if self.delivered != last[0]:
+                last = (self.delivered, time.perf_counter())
+            elif time.perf_counter() - last[1] > idle_timeout:
+                break
+
+    def pump(self, timeout):
+        """Reads whatever is ready and records a latency sample per delivery."""
+        for key, _ in self.selector.select(timeout):
+            client = key.data
+            try:
+                data = client.sock.recv(262144)
+            except OSError:
+                data = b''
+            if not data:
+                self.disconnects += 1
+                self.selector.unregister(client.sock)
+                continue
+            now = time.perf_counter_ns()
+            self.wire_bytes += len(data)
+            if client.stream is not None:
+                data = client.stream.feed(data)
+            for frame_type, payload in client.decoder.feed(data):
+                if frame_type == FRAME_CHAT:
+                    match = BENCH_TOKEN.search(payload, CHAT_SEQ.size)
+                    if match:
+                        self.latency['broadcast'].append(now - int(match.group(1)))
+                        self.delivered += 1
+                elif frame_type == FRAME_TEXT:
+                    if payload.find(b'[PM @') != -1:
+                        match = BENCH_TOKEN.search(payload)
+                        if match:
+                            self.latency['pm'].append(now - int(match.group(1)))
+                            self.delivered += 1
+                    elif client.pending_users and payload.find(b'Online users') != -1:
+                        self.latency['users'].append(now - client.pending_users.popleft())
+                        self.delivered += 1
+                    elif not client.welcomed and payload.find(b'Welcome to V-Chat') != -1:
+                        client.welcomed = True
+                        self.latency['connect'].append(now - client.connected_at)
+                elif frame_type == FRAME_PING:
+                    client.sock.sendall(encode_frame(FRAME_PONG, payload))
+
+def print_benchmark_summary(results):
+    """Prints the headline numbers of a benchmark run."""
+    throughput = results['throughput']
+    memory = results['memory']
+    cpu = results['cpu']
+    print(f"\n{COLORS['blue']}[*]{COLORS['reset']} {results['engine']} engine, {results['clients']} clients, "
+          f"{throughput['messages_per_s']} msg/s sent, {throughput['deliveries_per_s']} deliveries/s "
+          f"({throughput['delivery_ratio'] * 100:.2f}% delivered)")
+    for op, stats in results['latency_ms'].items():
+        if stats['count']:
+            print(f"    {op:<9} p50 {stats['p50']:>8.3f} ms  p99 {stats['p99']:>8.3f} ms  p999 {stats['p999']:>8.3f} ms  ({stats['count']} samples)")
+    if memory['bytes_per_connection'] is not None:
+        print(f"    memory    {memory['bytes_per_connection'] / 1024:.1f} KB per connection")
+    print(f"    cpu       server {cpu['server_percent']}%, load generator {cpu['driver_percent']}%")
+    print(f"    wire      {results['wire']['bytes_per_s'] / 1024:.1f} KB/s, {results['wire']['bytes_per_delivery']} bytes per delivery"
+          f" ({results['compression'] or 'uncompressed'})")
+    retried = results['connect']['over_1s']
+    print(f"    connect   {results['connect']['per_s']} connections/s"
+          + (f" ({retried} took over 1 s: SYN retransmits, so not a server baseline)" if retried else ""))
+    tls = results['tls']
+    if tls is not None and tls['full_handshake_ms']['count']:
+        print(f"    tls       handshake p50 {tls['full_handshake_ms']['p50']:.3f} ms full, "
+              f"{tls['resumed_handshake_ms']['p50']:.3f} ms resumed ({tls['resumed_ratio'] * 100:.0f}% resumed)")
+
+def compare_benchmarks(runs):
+    """Lines up benchmark runs ({label: results}, plain first) on cost per delivery and rates."""
+    def per_delivery(results):
+        return results['wire']['bytes_per_delivery'] or 0
+
+    def cpu_per_delivery(results, side):
+        deliveries = results['throughput']['deliveries']
+        return round(results['cpu'][f'{side}_seconds'] * 1e6 / deliveries, 2) if deliveries else None
+
+    plain = per_delivery(runs['plain'])
+    return {
+        'bytes_per_delivery': {label: per_delivery(results) for label, results in runs.items()},
+        'bandwidth_saved_percent': {label: round(100 * (1 - per_delivery(results) / plain), 1) if plain else 0.0
+                                    for label, results in runs.items() if label != 'plain'},
+        'server_cpu_us_per_delivery': {label: cpu_per_delivery(results, 'server') for label, results in runs.items()},
+        'client_cpu_us_per_delivery': {label: cpu_per_delivery(results, 'driver') for label, results in runs.items()},
+        'connections_per_s': {label: results['connect']['per_s'] for label, results in runs.items()},
+        'deliveries_per_s': {label: results['throughput']['deliveries_per_s'] for label, results in runs.items()},
+        'broadcast_p99_ms': {label: results['latency_ms']['broadcast'].get('p99') for label, results in runs.items()},
+    }
 
 class ChatClient:
-    def __init__(self, host, port, username, user_color, arrow_color):
+    """Terminal chat client; also usable in-process through start(), send() and close().
+
+    `on_message` receives every line the client would print (already rendered);
+    by default lines go to stdout. `headless` skips the help text. Embedded
+    clients are silent; with `sounds` at most one notification sound plays per
+    `sound_window` seconds.
+    """
+    def __init__(self, host, port, username, user_color='green', arrow_color='blue', compress=False, tls=None,
+                 on_message=None, headless=False, sounds=False, sound_window=SOUND_WINDOW):
+        self.host = host
+        self.port = port
         self.username = username
         self.user_color = user_color
         self.arrow_color = arrow_color
         self.running = True
-        
-        try:
-            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client.connect((host, port))
-            
-            # Send initial client data (username and colors)
-            self.client.send(f"{username}|{user_color}|{arrow_color}".encode('utf-8'))
-            
-            print(f"\n{COLORS['green']}[+]{COLORS['reset']} Connected to {host}:{port} as {COLORS[user_color]}[{username}]{COLORS['reset']}")
-            
-            self.print_help()
-            
-        except ConnectionRefusedError:
-            self.show_connection_error(host, port)
-            sys.exit(1)
-        except Exception as e:
-            print(f"{COLORS['red']}[!] Connection error: {e}{COLORS['reset']}")
-            sys.exit(1)
+        self.last_seq = 0  # Highest room-broadcast sequence number seen, for /since
+        self.send_lock = threading.Lock()
+        self.client = None
+        self.connected = False
+        self.session_token = None  # Issued by the server; lets a reconnect reattach this session
+        self.pending = deque(maxlen=PENDING_LIMIT)  # Typed while the connection was down
+        self.compress = compress  # Ask the server for a deflate stream (slow links)
+        self.tls = tls            # Client TLS context, or None for plaintext
+        self.tls_session = None   # Offered on reconnect to skip the full TLS handshake
+        self.display = on_message or print
+        self.headless = headless
+        self.sounds = SoundNotifier(sound_window) if sounds else None
+        # Live lines that mention us get the mention sound; the server leaves sounds to us
+        self.mention_me = re.compile('@' + re.escape(username) + r'(?![a-zA-Z0-9_])')
+        self.receive_thread = None
+
+    def start(self):
+        """Connects and starts receiving in the background. Raises OSError if the server is unreachable. Returns self."""
+        self.connect()
+        self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
+        self.receive_thread.start()
+        return self
+
+    def send(self, msg):
+        """Sends a chat line or command. Returns False if it was queued for after a reconnect."""
+        return self.send_text(msg)
+
+    def close(self):
+        """Leaves the chat (as /exit does) and closes the connection."""
+        if self.running:
+            self.running = False
+            try:
+                self.send_frame(FRAME_TEXT, "/exit")
+            except Exception:
+                pass
+        if self.client is not None:
+            self.client.close()
+        if self.receive_thread is not None:
+            self.receive_thread.join(1)
 
     def show_connection_error(self, host, port):
         """Display detailed connection error."""
@@ -415,41 +3744,289 @@ class ChatClient:
         print(f"{COLORS['yellow']}/exit{COLORS['reset']} - Disconnect from chat")
         print(f"{COLORS['yellow']}/msg username message{COLORS['reset']} - Send private message")
         print(f"{COLORS['yellow']}/users{COLORS['reset']} - List online users")
+        print(f"{COLORS['yellow']}/notify [on|off]{COLORS['reset']} - Turn notification sounds on or off")
+        print(f"{COLORS['yellow']}/join room{COLORS['reset']} - Switch to (or create) a room")
+        print(f"{COLORS['yellow']}/part{COLORS['reset']} - Go back to #{DEFAULT_ROOM}")
+        print(f"{COLORS['yellow']}/rooms{COLORS['reset']} - List rooms with member counts")
+        print(f"{COLORS['yellow']}/history [N|15m]{COLORS['reset']} - Replay recent messages")
+        print(f"{COLORS['yellow']}/since N{COLORS['reset']} - Replay everything after message number N")
+        print(f"{COLORS['yellow']}/stats{COLORS['reset']} - Server statistics (admins only)")
         print(f"{COLORS['yellow']}/help{COLORS['reset']} - Show this list again")
         print(f"{COLORS['yellow']}@username{COLORS['reset']} - Mention someone (plays sound on their end)")
         print(f"\n{COLORS['green']}Start chatting below:{COLORS['reset']}")
 
+    def connect(self):
+        """Opens a connection and sends the handshake, asking to resume the previous session if there was one."""
+        sock = socket.create_connection((self.host, self.port), timeout=RECONNECT_MAX_DELAY)
+        set_nodelay(sock)
+        if self.tls is not None:
+            sock = TlsChannel.client(self.tls, sock, self.host, self.tls_session)
+            sock.do_handshake()
+        sock.settimeout(CLIENT_PING_AFTER)
+        # Chat lines arrive unrendered and are coloured locally; a resume token and the
+        # last sequence number seen let the server reattach us and replay what we missed
+        capabilities = "structured,resume,localsound,deflate" if self.compress else "structured,resume,localsound"
+        if self.session_token:
+            capabilities += f",resume={self.session_token},since={self.last_seq}"
+        sock.sendall(encode_frame(FRAME_HANDSHAKE, f"{self.username}|{self.user_color}|{self.arrow_color}|{capabilities}"))
+        with self.send_lock:
+            self.client = sock
+            # A resume may be refused (another worker holds the session), so typed
+            # lines stay pending until the server confirms it with a token
+            self.connected = not self.session_token
+            self.decoder = FrameDecoder(TRUSTED_MAX_FRAME_SIZE)
+            self.stream = StreamInflater() if self.compress else None
+            self.issued = False  # Whether this connection has been given a session token
+            self.misrouted = False  # Reached a worker that does not hold our session
+            self.last_heard = time.monotonic()
+
+    def flush_pending(self):
+        """Marks the connection usable and sends what was typed while it was down."""
+        with self.send_lock:
+            self.connected = True
+            pending = list(self.pending)
+            self.pending.clear()
+        for msg in pending:
+            self.send_text(msg)
+
+    def reconnect(self, announce=True):
+        """Reconnects with exponential backoff and jitter. Returns False if the client was stopped."""
+        import random
+        delay = RECONNECT_MIN_DELAY
+        while self.running:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                self.connect()
+                if announce:
+                    self.display(f"{COLORS['green']}[+] Reconnected to {self.host}:{self.port}.{COLORS['reset']}")
+                return True
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        return False
+
+    def send_frame(self, frame_type, payload):
+        """Sends one framed message to the server."""
+        data = encode_frame(frame_type, payload)
+        # The input thread and heartbeat replies share the socket
+        with self.send_lock:
+            self.client.sendall(data)
+
+    def send_text(self, msg):
+        """Sends a line of input, keeping it for after the reconnect if the connection is down."""
+        with self.send_lock:
+            if self.connected:
+                try:
+                    self.client.sendall(encode_frame(FRAME_TEXT, msg))
+                    return True
+                except OSError:
+                    self.connected = False
+            self.pending.append(msg)
+        return False
+
+    def connection_lost(self):
+        """Decides what to do once the connection drops. Returns True if reconnected."""
+        with self.send_lock:
+            self.connected = False
+        if self.tls is not None:
+            self.tls_session = self.client.session
+        try:
+            self.client.close()
+        except Exception:
+            pass
+        if not self.running:
+            return False
+        if self.session_token is None or (not self.issued and self.decoder_used and not self.misrouted):
+            # Never had a session, or the server answered and then hung up (e.g. the
+            # username was taken while we were away): reconnecting will not help
+            self.display(f"\n{COLORS['red']}[!] Disconnected from server.{COLORS['reset']}")
+            self.running = False
+            return False
+        if self.misrouted:
+            # Keep trying until a connection lands on the worker that parked our session
+            return self.reconnect(announce=False)
+        self.display(f"\n{COLORS['yellow']}[*] Lost connection to server, reconnecting...{COLORS['reset']}")
+        return self.reconnect()
+
     def receive_messages(self):
         """Thread for receiving messages from the server."""
+        while self.running:
+            self.decoder_used = False
+            while self.running:
+                try:
+                    data = self.client.recv(65536)
+                    if not data:
+                        break # Server closed the connection
+                    self.last_heard = time.monotonic()
+                    self.decoder_used = True
+                    self.handle_frames(data)
+                except socket.timeout:
+                    # Quiet server: ping it, and give up on the connection if it stays silent
+                    if time.monotonic() - self.last_heard >= CLIENT_DEAD_AFTER:
+                        break
+                    try:
+                        self.send_frame(FRAME_PING, b'')
+                    except OSError:
+                        break
+                except OSError:
+                    break
+            if not self.connection_lost():
+                break
+
+    def handle_frames(self, data):
+        """Prints or acts on every complete frame in a chunk received from the server."""
+        if self.stream is not None:
+            data = self.stream.feed(data)
+        # A single recv may hold several frames (or only part of one)
+        for frame_type, payload in self.decoder.feed(data):
+            if frame_type == FRAME_TEXT:
+                self.display(payload.decode('utf-8', errors='replace'))
+            elif frame_type == FRAME_CHAT:
+                self.last_seq = max(self.last_seq, CHAT_SEQ.unpack_from(payload)[0])
+                self.display(payload[CHAT_SEQ.size:].decode('utf-8', errors='replace'))
+            elif frame_type == FRAME_FIELDS:
+                self.last_seq = max(self.last_seq, CHAT_SEQ.unpack_from(payload)[0])
+                line = self.render_fields(payload[CHAT_SEQ.size:])
+                self.display(line)
+                if self.sounds is not None:
+                    self.sounds.notify('mention' if self.mention_me.search(line) else 'notify')
+            elif frame_type == FRAME_SOUND and self.sounds is not None:
+                self.sounds.notify(payload.decode('utf-8', errors='replace'))
+            elif frame_type == FRAME_PING:
+                # Server heartbeat: answer so an idle session is not dropped
+                self.send_frame(FRAME_PONG, payload)
+            elif frame_type == FRAME_SESSION:
+                self.session_token = payload.decode('ascii', errors='replace')
+                self.issued = True
+                self.flush_pending()
+            elif frame_type == FRAME_RETRY:
+                self.misrouted = True
+            elif frame_type == FRAME_SEQ:
+                self.last_seq = max(self.last_seq, CHAT_SEQ.unpack_from(payload)[0])
+
+    def render_fields(self, data):
+        """Renders an unrendered chat line: [HH:MM:SS Username] » Message."""
+        fields = data.decode('utf-8', errors='replace').split('\0', 4)
+        if len(fields) != 5:
+            return fields[-1]
+        timestamp, username, user_color, arrow_color, message = fields
+        reset = COLORS['reset']
+        if '@' in message:
+            # Our own name stands out in our colour; other mentions in yellow
+            message = MENTION_PATTERN.sub(
+                lambda m: f"{COLORS[self.user_color] if m.group(1) == self.username else COLORS['yellow']}{m.group(0)}{reset}",
+                message)
+        return f"{COLORS.get(user_color, '')}[{timestamp} {username}]{reset} {COLORS.get(arrow_color, '')}»{reset} {message}"
+
+    def send_messages(self):
+        """Reads user input and sends it to the server."""
         while self.running:
             try:
-                # Use a larger buffer for potentially long colored messages
-                msg = self.client.recv(4096).decode('utf-8') 
-                if not msg:
-                    # Server closed the connection
-                    print(f"\n{COLORS['red']}[!] Disconnected from server.{COLORS['reset']}")
-                    self.running = False
+                msg = input()
+                if not msg.strip():
+                    continue
+                if not self.running:
                     break
                     
-                def run(self):
+                if msg.strip() == "/exit":
+                    self.running = False
+                    try:
+                        self.send_frame(FRAME_TEXT, msg)
+                    except Exception:
+                        pass
+                    break
+
+                if msg.split(maxsplit=1)[0] == "/notify":
+                    self.toggle_sounds(msg)
+                    continue
+
+                if not self.send_text(msg):
+                    print(f"{COLORS['yellow']}[*] Not connected; the message will be sent after reconnecting.{COLORS['reset']}")
+            except (KeyboardInterrupt, EOFError):
+                # Leave gracefully on Ctrl+C / Ctrl+D
+                try:
+                    self.send_frame(FRAME_TEXT, "/exit")
+                except Exception:
+                    pass
+                self.running = False
+                break
+            except Exception as e:
+                print(f"{COLORS['red']}[!] Send error: {e}{COLORS['reset']}")
+                self.running = False
+                break
+
+    def toggle_sounds(self, msg):
+        """Handles /notify [on|off] locally: turns notification sounds on or off."""
+        if self.sounds is None:
+            print(f"{COLORS['yellow']}[*] Sounds are not available in this client.{COLORS['reset']}")
+            return
+        arg = msg.split()[1].lower() if len(msg.split()) > 1 else ''
+        if arg in ('on', 'true'):
+            self.sounds.enabled = True
+        elif arg in ('off', 'false'):
+            self.sounds.enabled = False
+        elif arg:
+            print(f"{COLORS['red']}[!] Usage: /notify [on|off]{COLORS['reset']}")
+            return
+        else:
+            self.sounds.enabled = not self.sounds.enabled
+        state = "on" if self.sounds.enabled else "off"
+        print(f"{COLORS['green']}[*] Notification sounds {state}.{COLORS['reset']}")
+
+    def run(self):
         """Starts the client process."""
+        try:
+            self.connect()
+        except ConnectionRefusedError:
+            self.show_connection_error(self.host, self.port)
+            sys.exit(1)
+        except Exception as e:
+            print(f"{COLORS['red']}[!] Connection error: {e}{COLORS['reset']}")
+            sys.exit(1)
+        print(f"\n{COLORS['green']}[+]{COLORS['reset']} Connected to {self.host}:{self.port} as {COLORS[self.user_color]}[{self.username}]{COLORS['reset']}")
+        if not self.headless:
+            self.print_help()
+
         # Start the thread to listen for messages from the server
-        receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
-        receive_thread.start()
+        self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
+        self.receive_thread.start()
         
         # Start the main input thread
         self.send_messages()
         
         # Cleanup
         self.client.close()
-        receive_thread.join(1)
+        self.receive_thread.join(1)
+
+def config_arguments(path):
+    """Turns a JSON config file into command-line arguments that go before the real ones.
+
+    Keys are long option names ("engine", "bench-clients" or "bench_clients");
+    true adds a switch, false and null are skipped. Flags given on the command
+    line come later, so they override the file.
+    """
+    import json
+    with open(path) as config_file:
+        config = json.load(config_file)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path}: expected a JSON object of option names and values")
+    arguments = []
+    for key, value in config.items():
+        flag = '--' + key.lstrip('-').replace('_', '-')
+        if value is True:
+            arguments.append(flag)
+        elif value is not False and value is not None:
+            arguments += [flag, str(value)]
+    return arguments
 
 if __name__ == "__main__":
-    # Initialize colorama for Windows if available
-    try:
-        init(autoreset=True)
-    except NameError:
-        pass # colorama not imported
+    import argparse
+    if os.name == 'nt':
+        # Initialize colorama for Windows if available
+        try:
+            from colorama import init
+            init(autoreset=True)
+        except ImportError:
+            pass # colorama not installed
 
     # --- Argument Parsing ---
     parser = argparse.ArgumentParser(
@@ -471,30 +4048,320 @@ if __name__ == "__main__":
         action="store_true", 
         help="Run V-Chat in server mode."
     )
+    parser.add_argument(
+        "--engine",
+        choices=sorted(SERVER_ENGINES),
+        default="thread",
+        help="Server engine: 'thread' (one thread per client) or 'event' (single-threaded selectors loop for 10k+ clients)."
+    )
+    parser.add_argument(
+        "--send-queue",
+        type=int,
+        default=1024,
+        help="Max frames queued per client before the slow-consumer policy applies (default: 1024)."
+    )
+    parser.add_argument(
+        "--slow-consumer",
+        choices=SLOW_CONSUMER_POLICIES,
+        default="coalesce",
+        help="What to do when a client's send queue is full: drop new messages, disconnect the client, or coalesce the backlog (default)."
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=str,
+        help="Persist broadcasts and PMs to a segmented message log in this directory (enables /history)."
+    )
+    parser.add_argument(
+        "--log-segment-mb",
+        type=int,
+        default=16,
+        help="Size at which the message log starts a new segment file (default: 16)."
+    )
+    parser.add_argument(
+        "--recent",
+        type=int,
+        default=100,
+        help="Recent broadcasts kept in memory per room for instant catch-up (default: 100)."
+    )
+    parser.add_argument(
+        "--recent-kb",
+        type=int,
+        default=256,
+        help="Memory cap in KB for each room's recent-message buffer (default: 256)."
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="Max messages/sec per user, with bursts of twice that (default: 0, unlimited)."
+    )
+    parser.add_argument(
+        "--byte-limit-kb",
+        type=float,
+        default=0,
+        help="Max KB/sec per user (default: 0, unlimited)."
+    )
+    parser.add_argument(
+        "--room-rate-limit",
+        type=float,
+        default=0,
+        help="Max messages/sec broadcast in any one room (default: 0, unlimited)."
+    )
+    parser.add_argument(
+        "--room-byte-limit-kb",
+        type=float,
+        default=0,
+        help="Max KB/sec broadcast in any one room (default: 0, unlimited)."
+    )
+    parser.add_argument(
+        "--max-message-kb",
+        type=int,
+        default=MAX_FRAME_SIZE // 1024,
+        help=f"Largest message a client may send, in KB; bigger ones are discarded unread (default: {MAX_FRAME_SIZE // 1024})."
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="Collect server metrics (connections, traffic, commands, fan-out latency) for /stats."
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Also serve the metrics in Prometheus text format at http://127.0.0.1:PORT/metrics (implies --metrics)."
+    )
+    parser.add_argument(
+        "--admins",
+        type=str,
+        default="",
+        help="Comma-separated usernames allowed to use /stats (default: clients connecting from this machine)."
+    )
+    parser.add_argument(
+        "--log-file",
+        type=str,
+        help="Also write server events and chat as JSON lines to this file, rotated at 16 MB."
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Run without a terminal: no banners, help text, sounds or color prompts (use --color/--arrow-color); "
+             "a server also logs plain-text events only and does not echo chat."
+    )
+    parser.add_argument(
+        "--color",
+        choices=[name for name in COLORS if name != 'reset'],
+        help="Username color; skips the prompt (default with --headless: green)."
+    )
+    parser.add_argument(
+        "--arrow-color",
+        choices=[name for name in COLORS if name != 'reset'],
+        help="Message arrow color; skips the prompt (default with --headless: blue)."
+    )
+    parser.add_argument(
+        "--no-banner",
+        action="store_true",
+        help="Skip the start-up banner (and the server's local IP lookup)."
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        help="JSON file of option defaults, e.g. {\"engine\": \"event\", \"headless\": true}; command-line flags override it."
+    )
+    parser.add_argument(
+        "--heartbeat",
+        type=float,
+        default=30.0,
+        help="Ping clients after this many seconds of silence (default: 30, 0 disables)."
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=90.0,
+        help="Drop clients silent for this many seconds, pings unanswered (default: 90, 0 disables)."
+    )
+    parser.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=10.0,
+        help="Drop connections that have not completed the handshake in time (default: 10, 0 disables)."
+    )
+    parser.add_argument(
+        "--keepalive",
+        type=int,
+        default=60,
+        help="Start TCP keepalive probes after this many idle seconds (default: 60, 0 disables)."
+    )
+    parser.add_argument(
+        "--resume-grace",
+        type=float,
+        default=60.0,
+        help="Seconds a dropped client's session is held so it can reconnect and resume (default: 60, 0 disables)."
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        choices=range(0, 10),
+        default=6,
+        metavar="0-9",
+        help="zlib level for clients that ask for compression (server only, default: 6, 0 refuses compression)."
+    )
+    parser.add_argument(
+        "--tls-cert",
+        type=str,
+        help="Serve over TLS with this PEM certificate (server only; a self-signed one is fine for testing)."
+    )
+    parser.add_argument(
+        "--tls-key",
+        type=str,
+        help="PEM private key for --tls-cert, if it is not in the certificate file."
+    )
+    parser.add_argument(
+        "--tls",
+        action="store_true",
+        help="Connect over TLS (client; with --benchmark, also run the load over TLS)."
+    )
+    parser.add_argument(
+        "--tls-ca",
+        type=str,
+        help="Trust this CA or self-signed server certificate (PEM) instead of the system store."
+    )
+    parser.add_argument(
+        "--tls-insecure",
+        action="store_true",
+        help="Do not verify the server certificate (testing only)."
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Ask the server to compress everything it sends (client; also the --benchmark clients)."
+    )
+    parser.add_argument(
+        "--sound-window",
+        type=float,
+        default=SOUND_WINDOW,
+        help=f"Play at most one notification sound per this many seconds (client, default: {SOUND_WINDOW:g})."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Run N server worker processes sharing the port (Linux/BSD); they relay messages and user lists to each other."
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Run the built-in load benchmark against a local server using the server options given."
+    )
+    parser.add_argument(
+        "--bench-clients",
+        type=int,
+        default=200,
+        help="Simulated clients for --benchmark (default: 200)."
+    )
+    parser.add_argument(
+        "--bench-duration",
+        type=float,
+        default=10.0,
+        help="Seconds of load for --benchmark (default: 10)."
+    )
+    parser.add_argument(
+        "--bench-rate",
+        type=float,
+        default=100.0,
+        help="Total messages/sec sent during --benchmark (default: 100)."
+    )
+    parser.add_argument(
+        "--bench-size",
+        type=int,
+        default=64,
+        help="Approximate size of each benchmark message in bytes (default: 64)."
+    )
+    parser.add_argument(
+        "--bench-output",
+        type=str,
+        help="Write the --benchmark results as JSON to this file instead of stdout."
+    )
     parser.add_argument(
         "--username", 
         type=str, 
-        required=True, 
-        help="Your desired display username."
+        help="Your desired display username (required except for --benchmark)."
     )
-    args = parser.parse_args()
+    argv = sys.argv[1:]
+    config_path = parser.parse_known_args(argv)[0].config
+    if config_path:
+        try:
+            argv = config_arguments(config_path) + argv
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot read --config: {e}")
+    args = parser.parse_args(argv)
+    if not args.username and not args.benchmark:
+        parser.error("the following arguments are required: --username")
+
+    options = dict(send_queue_size=args.send_queue, slow_consumer=args.slow_consumer,
+                   log_dir=args.log_dir, log_segment_bytes=args.log_segment_mb * 1024 * 1024,
+                   recent_size=args.recent, recent_bytes=args.recent_kb * 1024,
+                   rate_limit=args.rate_limit, byte_limit=args.byte_limit_kb * 1024,
+                   room_rate_limit=args.room_rate_limit, room_byte_limit=args.room_byte_limit_kb * 1024,
+                   max_message_size=args.max_message_kb * 1024,
+                   metrics=args.metrics, metrics_port=args.metrics_port,
+                   admins=[name for name in args.admins.split(',') if name],
+                   log_file=args.log_file, headless=args.headless,
+                   heartbeat_interval=args.heartbeat, idle_timeout=args.idle_timeout,
+                   handshake_timeout=args.handshake_timeout, keepalive=args.keepalive,
+                   resume_grace=args.resume_grace, compression_level=args.compression_level,
+                   tls_cert=args.tls_cert, tls_key=args.tls_key)
+
+    if args.benchmark:
+        # Non-interactive: no banner or color prompts, JSON results for regression tracking
+        import json
+        # The same load again with deflate and/or TLS, so cost and savings can be compared
+        variants = {'plain': dict(options=dict(options, tls_cert=None))}
+        if args.compress:
+            variants['deflate'] = dict(options=dict(options, tls_cert=None), compress=True)
+        if args.tls:
+            if not args.tls_cert:
+                parser.error("--benchmark --tls needs --tls-cert (and --tls-key) for the benchmarked server")
+            variants['tls'] = dict(options=options, tls=client_tls_context(verify=False))
+        runs = {label: ChatBenchmark(args.engine, args.bench_clients, args.bench_duration, args.bench_rate,
+                                     args.bench_size, **variant).run()
+                for label, variant in variants.items()}
+        summaries = list(runs.values())
+        results = runs['plain'] if len(runs) == 1 else dict(runs, comparison=compare_benchmarks(runs))
+        if args.bench_output:
+            with open(args.bench_output, 'w') as output:
+                json.dump(results, output, indent=2)
+            for summary in summaries:
+                print_benchmark_summary(summary)
+            print(f"{COLORS['green']}[*] Results written to {args.bench_output}{COLORS['reset']}")
+        else:
+            print(json.dumps(results, indent=2))
+        sys.exit(0)
 
     # --- Setup and Run ---
-    print_banner()
-    
-    # Get user preferences for colors
-    user_color = choose_color("Choose username color")
-    arrow_color = choose_color("Choose message arrow color")
+    banner = not (args.headless or args.no_banner)
+    if banner:
+        print_banner()
+        
+    # Get user preferences for colors; nobody is at a headless terminal to answer prompts
+    user_color = args.color or ('green' if args.headless else choose_color("Choose username color"))
+    arrow_color = args.arrow_color or ('blue' if args.headless else choose_color("Choose message arrow color"))
 
     # Start application logic
     if args.server:
         # Server mode
-        server = ChatServer(args.host or "0.0.0.0", args.port, args.username, user_color, arrow_color)
-        server.run()
+        if args.workers > 1:
+            run_sharded(args.workers, args.engine, args.host or "0.0.0.0", args.port, args.username,
+                        user_color, arrow_color, dict(options, banner=banner))
+        else:
+            server_class = SERVER_ENGINES[args.engine]
+            server = server_class(args.host or "0.0.0.0", args.port, args.username, user_color, arrow_color,
+                                  banner=banner, **options)
+            server.run()
     else:
         # Client mode
         if not args.host:
             print(f"{COLORS['red']}[!] Must specify --host (IP of the server) when running in client mode.{COLORS['reset']}")
             sys.exit(1)
-        client = ChatClient(args.host, args.port, args.username, user_color, arrow_color)
+        tls = client_tls_context(args.tls_ca, verify=not args.tls_insecure) if args.tls or args.tls_ca else None
+        client = ChatClient(args.host, args.port, args.username, user_color, arrow_color, compress=args.compress, tls=tls,
+                            headless=args.headless, sounds=not args.headless, sound_window=args.sound_window)
         client.run()